@@ -0,0 +1,164 @@
+import io
+import json
+import logging
+import mmap
+import os
+from hashlib import sha256
+from time import time
+from typing import List, Optional
+
+from cache import CACHE_PATH
+from files import write_atomic
+
+BLOB_PATH = os.path.join(CACHE_PATH, 'blobs')
+
+logger = logging.getLogger('BlobStore')
+
+
+class BlobReader(io.RawIOBase):
+    """ A read-only file object over a memory-mapped blob. Can be passed to `discord.File`. """
+
+    _file: io.BufferedReader
+    _mm: Optional[mmap.mmap]
+    _pos: int = 0
+
+    def __init__(self, path: str):
+        super().__init__()
+        self._file = open(path, 'rb')
+
+        # Empty files cannot be mapped
+        size = os.fstat(self._file.fileno()).st_size
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+
+    def __len__(self) -> int:
+        return len(self._mm) if self._mm else 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        n = min(len(b), len(self) - self._pos)
+        if n <= 0:
+            return 0
+
+        # Copy straight from the mapping, slicing the mmap would make an intermediate copy
+        with memoryview(self._mm) as view:
+            b[:n] = view[self._pos:self._pos + n]
+        self._pos += n
+
+        return n
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self)
+
+        self._pos = max(offset, 0)
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def close(self):
+        if not self.closed:
+            if self._mm:
+                self._mm.close()
+            self._file.close()
+
+        super().close()
+
+
+class BlobStore:
+    """
+    Stores binary payloads under their sha256 digest in the `cache/blobs/` folder. A JSON sidecar next to each blob
+    holds its metadata. Storing the same payload twice only writes it once.
+    """
+
+    @staticmethod
+    def _get_path(digest: str) -> str:
+        """ Get the path of the blob. The metadata is stored at the same path with a `.json` suffix. """
+        return os.path.join(BLOB_PATH, digest)
+
+    @classmethod
+    def put(cls, data: bytes, **meta) -> str:
+        """ Store the payload unless it is stored already.
+
+        :param data: The payload.
+        :param meta: JSON-serializable metadata to store along with the payload, e.g. the content type.
+        :return: The sha256 hex digest of the payload, under which it can be retrieved.
+        """
+
+        digest = sha256(data).hexdigest()
+        path = cls._get_path(digest)
+
+        if os.path.exists(path):
+            logger.debug(f'Blob {digest} is already stored.')
+            return digest
+
+        os.makedirs(BLOB_PATH, exist_ok=True)
+
+        # The sidecar goes first, so every stored blob has its metadata
+        meta = dict(meta, size=len(data), created=time())
+        write_atomic(path + '.json', json.dumps(meta).encode())
+        write_atomic(path, data)
+
+        logger.debug(f'Stored blob {digest} ({len(data)} bytes)')
+
+        return digest
+
+    @classmethod
+    def exists(cls, digest: str) -> bool:
+        return os.path.exists(cls._get_path(digest))
+
+    @classmethod
+    def get_meta(cls, digest: str) -> Optional[dict]:
+        """ Return the metadata of the blob or None if it is not stored. """
+        try:
+            with open(cls._get_path(digest) + '.json') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return
+
+    @classmethod
+    def open(cls, digest: str) -> BlobReader:
+        """ Open the blob for reading. The payload is memory-mapped instead of being read into memory.
+
+        :raises FileNotFoundError: The blob is not stored.
+        """
+        return BlobReader(cls._get_path(digest))
+
+    @classmethod
+    def remove(cls, digest: str):
+        """ Remove the blob and its metadata if stored. """
+        path = cls._get_path(digest)
+
+        for _path in (path, path + '.json'):
+            try:
+                os.remove(_path)
+            except FileNotFoundError:
+                pass
+
+        logger.debug(f'Removed blob {digest}')
+
+    @classmethod
+    def find(cls, **meta) -> List[str]:
+        """ Return the digests of the stored blobs whose metadata contains all the given items. """
+        try:
+            names = os.listdir(BLOB_PATH)
+        except FileNotFoundError:
+            return []
+
+        digests = [name[:-len('.json')] for name in names if name.endswith('.json') and not name.startswith('.')]
+        return [digest for digest in digests
+                if (stored := cls.get_meta(digest)) is not None and all(stored.get(k) == v for k, v in meta.items())]
+
+    @classmethod
+    def remove_stale(cls, keep: str, **meta):
+        """ Remove the blobs whose metadata contains all the given items, except the one to keep. """
+        for digest in cls.find(**meta):
+            if digest != keep:
+                cls.remove(digest)
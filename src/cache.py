@@ -1,68 +1,218 @@
+import asyncio
 import logging
 import os
 import pickle
+from collections import OrderedDict
 from dataclasses import dataclass
 from time import time
-from typing import Any
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from files import write_atomic
 
 CACHE_PATH = 'cache/'
 
-logger = logging.getLogger('Cache')
+# Limits of the in-memory tier, the least recently used entries are evicted first
+MAX_MEMORY_ENTRIES = 64
+MAX_MEMORY_BYTES = 32 * 1024 * 1024
 
-# Ensure the cache dir is present so we do not have to check for it every time.
-os.makedirs(CACHE_PATH, exist_ok=True)
+logger = logging.getLogger('Cache')
 
 
 @dataclass
 class CacheEntry:
     timestamp: float
     obj: Any
+    ttl: Optional[float] = None  # Seconds the entry lasts, None if it does not expire by itself
+
+    def expired(self, lasts_seconds: float = 0) -> bool:
+        """ Whether the entry has expired by its own ttl or is older than `lasts_seconds` (0 ignores the age). """
+        age = time() - self.timestamp
+        return (self.ttl is not None and age >= self.ttl) or (lasts_seconds != 0 and age >= lasts_seconds)
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0  # Served from the memory
+    disk_hits: int = 0  # Served from the disk
+    misses: int = 0
+    evictions: int = 0  # Dropped from the memory to stay within the limits
+    expirations: int = 0
 
 
 class Cache:
+    """
+    A two-tier key: value cache. Values are pickled to the `cache/` folder and the recently used ones are also kept
+    in memory, so warm reads do not touch the disk.
+
+    Attributes:
+        stats: The hit, miss and eviction counters.
+    """
+
+    stats = CacheStats()
+
+    _memory: 'OrderedDict[str, CacheEntry]' = OrderedDict()
+    _sizes: Dict[str, int] = {}  # The pickled size of the entries in memory
+    _memory_bytes = 0
+    _in_flight: Dict[str, asyncio.Future] = {}  # key: the future of the computation in progress
+
     @staticmethod
     def _get_path(key: str) -> str:
         """ Get the path of the file with the cached object depending on the key. """
         return os.path.join(CACHE_PATH, key)
 
     @classmethod
-    def cache(cls, key: str, value: Any):
-        """ Cache a key: value pair which can be retrieved later. """
-        _entry = CacheEntry(time(), value)
+    def _remember(cls, key: str, entry: CacheEntry, size: int):
+        """ Put the entry to the memory tier and evict the least recently used entries over the limits. """
+        cls._forget(key)
+
+        # Do not let a single entry flush the whole memory
+        if size > MAX_MEMORY_BYTES:
+            return
+
+        cls._memory[key] = entry
+        cls._sizes[key] = size
+        cls._memory_bytes += size
+
+        while len(cls._memory) > MAX_MEMORY_ENTRIES or cls._memory_bytes > MAX_MEMORY_BYTES:
+            evicted, _ = cls._memory.popitem(last=False)
+            cls._memory_bytes -= cls._sizes.pop(evicted)
+            cls.stats.evictions += 1
+            logger.debug(f'Evicted "{evicted}" from the memory.')
+
+    @classmethod
+    def _forget(cls, key: str):
+        if cls._memory.pop(key, None) is not None:
+            cls._memory_bytes -= cls._sizes.pop(key)
+
+    @classmethod
+    def _write(cls, key: str, entry: CacheEntry) -> int:
+        """ Pickle the entry to its file. Return the size of the pickled entry. Does not touch the memory tier. """
         _path = cls._get_path(key)
+        _data = pickle.dumps(entry)
 
-        # Open file and dump
-        with open(_path, 'wb') as f:
-            pickle.dump(_entry, f)
+        # The cached file is never half-written
+        os.makedirs(CACHE_PATH, exist_ok=True)
+        write_atomic(_path, _data)
 
         logger.debug(f'Cached "{key}" to "{_path}"')
 
+        return len(_data)
+
+    @classmethod
+    def _read(cls, key: str) -> Optional[Tuple[CacheEntry, int]]:
+        """ Unpickle the entry from its file. Return the entry and its pickled size. Does not touch the memory tier. """
+        _path = cls._get_path(key)
+
+        try:
+            with open(_path, 'rb') as f:
+                _data = f.read()
+            return pickle.loads(_data), len(_data)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            logger.debug(f'{_path} not found.')
+
     @classmethod
-    def load(cls, key: str, lasts_seconds: int) -> Any:
+    def _load_memory(cls, key: str, lasts_seconds: float) -> Optional[CacheEntry]:
+        _entry = cls._memory.get(key)
+        if _entry is None:
+            return
+
+        if _entry.expired(lasts_seconds):
+            cls._forget(key)
+            cls.stats.expirations += 1
+            logger.debug(f'The cached value for key {key} has expired.')
+            return
+
+        cls._memory.move_to_end(key)
+        cls.stats.hits += 1
+        return _entry
+
+    @classmethod
+    def _accept_disk(cls, key: str, lasts_seconds: float,
+                     read: Optional[Tuple[CacheEntry, int]]) -> Optional[CacheEntry]:
+        """ Count the outcome of a disk read and put the unexpired entry to the memory tier. """
+        if read is None:
+            cls.stats.misses += 1
+            return
+
+        _entry, _size = read
+        if _entry.expired(lasts_seconds):
+            cls.stats.expirations += 1
+            logger.debug(f'The cached value for key {key} has expired.')
+            return
+
+        cls._remember(key, _entry, _size)
+        cls.stats.disk_hits += 1
+        logger.debug(f'Returned cached value for key {key}.')
+
+        return _entry
+
+    @classmethod
+    def cache(cls, key: str, value: Any, ttl: float = None):
+        """ Cache a key: value pair which can be retrieved later.
+
+        :param key: The key.
+        :param value: A picklable value.
+        :param ttl: The amount of seconds the value should last. None if it should not expire by itself.
+        """
+
+        _entry = CacheEntry(time(), value, ttl)
+        cls._remember(key, _entry, cls._write(key, _entry))
+
+    @classmethod
+    def load(cls, key: str, lasts_seconds: int = 0) -> Any:
         """ Return the cached value for the key.
 
         :param key: The key.
         :param lasts_seconds: The amount of seconds the value should last. None will be returned if the cached value
-            has already expired. Set to 0 if the cached value should never expire.
+            has already expired. Set to 0 if the cached value should never expire, unless it has its own ttl.
         :return: Cached value for key. None if expired or no value is cached for the specified key.
         """
 
-        _path = cls._get_path(key)
+        _entry = cls._load_memory(key, lasts_seconds) or cls._accept_disk(key, lasts_seconds, cls._read(key))
+        return _entry and _entry.obj
 
-        try:
-            with open(_path, 'rb') as f:
-                _entry: CacheEntry = pickle.load(f)
-        except (OSError, FileNotFoundError):
-            logger.debug(f'{_path} not found.')
-            return
+    @classmethod
+    async def get_or_compute(cls, key: str, ttl: float, producer: Callable[[], Awaitable[Any]]) -> Any:
+        """ Return the cached value for the key or compute and cache it. The disk is accessed in an executor.
 
-        # print(_entry.obj)
+        Concurrent calls for the same key share a single computation.
 
-        if lasts_seconds == 0 or time() - _entry.timestamp < lasts_seconds:
-            logger.debug(f'Returned cached value for key {key}.')
-            return _entry.obj
+        :param key: The key.
+        :param ttl: The amount of seconds the value should last. 0 if it should never expire.
+        :param producer: A coroutine function computing the value. The value is not cached if it returns None.
+        :return: The cached or computed value.
+        """
 
-        logger.debug(f'The cached value for key {key} has expired.')
+        # Join the computation in progress
+        if key in cls._in_flight:
+            return await asyncio.shield(cls._in_flight[key])
+
+        loop = asyncio.get_event_loop()
+        future = cls._in_flight[key] = loop.create_future()
+
+        try:
+            _entry = cls._load_memory(key, ttl)
+            if _entry is None:
+                _entry = cls._accept_disk(key, ttl, await loop.run_in_executor(None, cls._read, key))
+
+            if _entry is not None:
+                value = _entry.obj
+            else:
+                value = await producer()
+
+                if value is not None:
+                    _entry = CacheEntry(time(), value, ttl or None)
+                    cls._remember(key, _entry, await loop.run_in_executor(None, cls._write, key, _entry))
+        except BaseException as ex:
+            future.set_exception(ex)
+            # Do not warn about an exception nobody waited for
+            future.exception()
+            raise
+        else:
+            future.set_result(value)
+            return value
+        finally:
+            del cls._in_flight[key]
 
 
 if __name__ == '__main__':
@@ -0,0 +1,99 @@
+import datetime
+from bisect import bisect_left
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from discord import Embed
+
+import common
+from dates import parse_date
+
+Key = Tuple[datetime.date, int]
+
+
+@dataclass(frozen=True)
+class IndexEntry:
+    """
+    The summary of an embed posted in an exam or homework channel.
+
+    Attributes:
+        message_id: The id of the message with the embed.
+        title: The title of the embed.
+        description: The description of the embed, usually the date.
+        date: The date parsed from the description. None if it is not a date.
+        field_names: The names of the embed fields.
+    """
+
+    message_id: int
+    title: str
+    description: str
+    date: Optional[datetime.datetime]
+    field_names: Tuple[str, ...]
+
+    @classmethod
+    def from_embed(cls, message_id: int, embed: Embed) -> 'IndexEntry':
+        description = embed.description or ''
+        return cls(message_id, embed.title or '', description, parse_date(description),
+                   tuple(f.name for f in embed.fields))
+
+    @property
+    def key(self) -> Key:
+        """ The sort key. Entries without a date come last, entries of the same day are sorted by the message. """
+        return (self.date or common.MAX_DATETIME).date(), self.message_id
+
+
+class ChannelIndex:
+    """
+    The entries of a channel kept sorted by the date. Iterating yields the latest dates first, the newest message
+    first on the same day.
+    """
+
+    _keys: List[Key]  # The sort keys of the entries, in the same order
+    _entries: List[IndexEntry]
+    _by_message_id: Dict[int, IndexEntry]
+
+    def __init__(self, entries: Iterable[IndexEntry] = ()):
+        self._entries = sorted(entries, key=lambda i: i.key)
+        self._keys = [i.key for i in self._entries]
+        self._by_message_id = {i.message_id: i for i in self._entries}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self) -> Iterator[IndexEntry]:
+        return reversed(self._entries)
+
+    def __contains__(self, message_id: int) -> bool:
+        return message_id in self._by_message_id
+
+    def get(self, message_id: int) -> Optional[IndexEntry]:
+        return self._by_message_id.get(message_id)
+
+    def put(self, entry: IndexEntry):
+        """ Insert the entry, replacing the entry of the same message. """
+        self.remove(entry.message_id)
+
+        i = bisect_left(self._keys, entry.key)
+        self._keys.insert(i, entry.key)
+        self._entries.insert(i, entry)
+        self._by_message_id[entry.message_id] = entry
+
+    def remove(self, message_id: int) -> bool:
+        """ Remove the entry of the message. Return whether there was one. """
+        if (entry := self._by_message_id.pop(message_id, None)) is None:
+            return False
+
+        i = bisect_left(self._keys, entry.key)
+        del self._keys[i]
+        del self._entries[i]
+
+        return True
+
+    def trim(self, limit: int) -> List[int]:
+        """ Remove the entries of the oldest messages over the limit. Return the ids of their messages. """
+        removed = sorted(self._by_message_id)[:-limit]
+
+        for message_id in removed:
+            self.remove(message_id)
+
+        return removed
@@ -1,17 +1,21 @@
-import io
 import logging
-import sys
+from dataclasses import dataclass
+from time import perf_counter
 from traceback import format_exc
+from typing import Dict, List
 
 import click
 from aiohttp import ClientSession
 from discord import Guild, Message
-from discord.ext.commands import Bot, Context
+from discord.ext.commands import Bot, Command, Context
 
 from config import Config
 from cogs.config import GuildConfig
+from database import close_database
+from dates import warm_up
 from errors import ErrorHandler
 from exceptions import MarvinInitializeException
+from startup import StartupOrchestrator
 from store import Store
 from data import ensure_data_dir
 
@@ -33,31 +37,39 @@ EXTENSIONS = [
     'cogs.ok',
     'cogs.counting_channel',
     'cogs.embed_datetime_formatter',
+    'cogs.summaries',
 ]
 
+# Extensions providing only commands. These are loaded on the first invocation of one of their commands. Until then,
+# a stub with the given help is registered for each command name.
+LAZY_EXTENSIONS = {
+    'embeds': {'embed': 'An embed builder.'},
+    'cogs.new_config': {'con': 'Bot configuration commands.'},
+}
 
-# Logging
-log_format = '[%(levelname)-8s] [%(name)-16s] %(message)s'
-logging.basicConfig(level=Config.loglevel, format=log_format, stream=sys.stdout)
-if not Config.modulelog:
-    logging.getLogger('discord.gateway').disabled = True
-    logging.getLogger('discord.client').disabled = True
-    logging.getLogger('discord.http').disabled = True
-    logging.getLogger('websockets.protocol').disabled = True
-
-# !log handler
-root = logging.getLogger()
-handler = logging.StreamHandler(io.StringIO())
-handler.setFormatter(logging.Formatter(log_format))
-root.addHandler(handler)
 
 logger = logging.getLogger('Client')
 
 
+@dataclass
+class ExtensionProfile:
+    name: str
+    import_seconds: float = 0  # The execution of the module body along with the import of its dependencies
+    setup_seconds: float = 0  # The setup function, e.g. the construction of the cogs
+    lazy: bool = False
+
+    @property
+    def load_seconds(self) -> float:
+        return self.import_seconds + self.setup_seconds
+
+
 class Marvin(Bot):
     guild: Guild
     error_handler = ErrorHandler()
     session: ClientSession
+    startup: StartupOrchestrator
+    startup_profile: List[ExtensionProfile]
+    _import_seconds: float = 0  # How long the module body of the last loaded extension took to execute
 
     def __init__(self, *args, **kw):
         super().__init__(*args, **kw)
@@ -68,15 +80,95 @@ class Marvin(Bot):
         self.store = Store()
         self.store.load()
 
+        # The cogs declare their initialization steps while being loaded
+        self.startup = StartupOrchestrator()
+        self.startup.add_step('dates', warm_up)
+
         # Load extensions
+        self.startup_profile = []
         for extension in EXTENSIONS:
             try:
-                self.load_extension(extension)
+                if extension in LAZY_EXTENSIONS:
+                    self._add_stubs(extension, LAZY_EXTENSIONS[extension])
+                    self.startup_profile.append(ExtensionProfile(extension, lazy=True))
+                else:
+                    self.startup_profile.append(self._load_extension_timed(extension))
             except Exception:
                 click.secho(f'Failed to laod the extension [{extension}]!', fg='red')
                 logger.error(format_exc())
                 raise MarvinInitializeException
 
+        self._print_startup_profile()
+
+    def _load_extension_timed(self, extension: str) -> ExtensionProfile:
+        """ Load the extension and measure how long its import and its setup took. """
+        start = perf_counter()
+        self.load_extension(extension)
+        load_seconds = perf_counter() - start
+
+        return ExtensionProfile(extension, self._import_seconds, load_seconds - self._import_seconds)
+
+    def _load_from_module_spec(self, spec, key):
+        # discord.py executes the module body itself, importing it beforehand would execute it twice. Time the
+        # execution of the body instead, the rest of the load is the setup.
+        exec_module = spec.loader.exec_module
+
+        def exec_module_timed(module):
+            start = perf_counter()
+            try:
+                exec_module(module)
+            finally:
+                self._import_seconds = perf_counter() - start
+
+        spec.loader.exec_module = exec_module_timed
+        super()._load_from_module_spec(spec, key)
+
+    def _add_stubs(self, extension: str, commands: Dict[str, str]):
+        """ Register stub commands, which load the extension on the first invocation. """
+        for name, help_ in commands.items():
+            self.add_command(self._make_stub(extension, name, help_))
+
+    def _make_stub(self, extension: str, name: str, help_: str) -> Command:
+        async def stub(ctx: Context, *_):
+            self._load_lazy_extension(extension)
+
+            # Invoke the actual command
+            await self.invoke(await self.get_context(ctx.message))
+
+        return Command(stub, name=name, help=help_)
+
+    def _load_lazy_extension(self, extension: str):
+        if extension in self.extensions:
+            return
+
+        # Make room for the actual commands
+        for name in LAZY_EXTENSIONS[extension]:
+            self.remove_command(name)
+
+        profile = self._load_extension_timed(extension)
+        logger.info(f'Loaded the extension {extension} on demand in '
+                    f'{profile.load_seconds * 1000:.1f} ms')
+
+    def _print_startup_profile(self):
+        click.echo(f'{"Extension":<30}{"Import":>12}{"Setup":>12}')
+
+        for profile in self.startup_profile:
+            if profile.lazy:
+                click.echo(f'{profile.name:<30}{"on demand":>12}')
+            else:
+                click.echo(f'{profile.name:<30}{profile.import_seconds * 1000:>9.1f} ms'
+                           f'{profile.setup_seconds * 1000:>9.1f} ms')
+
+        import_total = sum(i.import_seconds for i in self.startup_profile)
+        setup_total = sum(i.setup_seconds for i in self.startup_profile)
+        click.echo(f'{"Total":<30}{import_total * 1000:>9.1f} ms{setup_total * 1000:>9.1f} ms')
+
+    async def close(self):
+        # Write the pending store changes before the loop stops
+        self.store.flush()
+        await super().close()
+        await close_database()
+
     async def on_connect(self):
         # Create an aiohttp session
         self.session = ClientSession()
@@ -85,10 +177,13 @@ class Marvin(Bot):
         self.guild = self.get_guild(Config.guild_id)
 
         # Populate config db for each guild
-        GuildConfig.add_guilds([guild.id for guild in self.guilds])
+        await GuildConfig.add_guilds([guild.id for guild in self.guilds])
 
-    # noinspection PyMethodMayBeStatic
     async def on_ready(self):
+        # Run the initialization steps of the cogs, only on the first ready
+        await self.startup.run()
+        await self.startup.wait_ready()
+
         logger.info(f'Client: Ready!')
 
     async def on_command_error(self, ctx: Context, exception):
@@ -1,9 +1,13 @@
+from typing import Set
+
 from discord import Message
 from discord.ext.commands import Cog
 
 from client import Marvin
 from remote_config import RemoteConfig
 
+CONFIG_KEYS = {'auto_reactor_channel_ids', 'auto_reactor_reaction_ids'}
+
 
 class AutoReactor(Cog):
     bot: Marvin
@@ -12,12 +16,17 @@ class AutoReactor(Cog):
 
     def __init__(self, bot: Marvin):
         self.bot = bot
+        self._load_config()
 
-    @Cog.listener()
-    async def on_ready(self):
+    def _load_config(self):
         self._channels = RemoteConfig.auto_reactor_channel_ids
         self._reactions = RemoteConfig.auto_reactor_reaction_ids
 
+    @Cog.listener()
+    async def on_remote_config_change(self, keys: Set[str]):
+        if keys & CONFIG_KEYS:
+            self._load_config()
+
     @Cog.listener()
     async def on_message(self, msg: Message):
         # Skip own messages
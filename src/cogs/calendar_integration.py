@@ -1,28 +1,107 @@
+import asyncio
 import datetime
+import json
 import logging
 import os
 import pickle
-import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-
-import dateparser
-from discord import Message, RawMessageDeleteEvent, RawMessageUpdateEvent
+from functools import lru_cache
+from hashlib import sha1
+from random import random
+from time import monotonic
+from traceback import format_exc
+from typing import TYPE_CHECKING, Any, AsyncGenerator, Callable, Dict, List, Optional, Set, Tuple
+
+from discord import Embed, Guild, Message, NotFound, Object, RawMessageDeleteEvent, RawMessageUpdateEvent
+from discord.ext import tasks
 from discord.ext.commands import Cog, Context, group, has_role
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient import discovery
 from oauthlib.oauth2 import InvalidGrantError
 import click
 
 from client import Marvin
 from cogs.config import GuildConfig
+from database import get_database
+from dates import parse_date
 from decorators import del_invoc
+from files import write_atomic
 from timeout_message import TimeoutMessage
 from utils import UserInput
 
+# The google client libraries are only imported when needed
+if TYPE_CHECKING:
+    from googleapiclient.discovery import Resource
+    from googleapiclient.http import HttpRequest
+
 logger = logging.getLogger('CalendarIntegration')
 logging.getLogger('googleapiclient.discovery_cache').setLevel(logging.ERROR)
 
 SECRET_FILENAME = 'secret.json'
+CREDS_DIR = 'creds/calendar/'
+
+# Bundled, so building a service never fetches the discovery document
+DISCOVERY_DOCUMENT_PATH = 'res/discovery/calendar.v3.json'
+
+# Changes of a message made within this many seconds are synced together
+SYNC_DELAY = 3
+# The number of batch requests running at once
+SYNC_WORKERS = 4
+# The maximum number of operations in a batch request
+BATCH_SIZE = 50
+# Jobs becoming due within this many seconds are put into the same batch
+BATCH_WINDOW = 0.5
+# Requests failing with these statuses are retried with an exponential backoff
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_ATTEMPTS = 5
+BACKOFF_SECONDS = 1
+
+# The number of messages parsed and pushed at once by the backfill
+BACKFILL_PAGE_SIZE = 100
+# The number of threads parsing the dates during the backfill
+BACKFILL_PARSERS = 4
+# The minimal number of seconds between the backfill progress updates
+BACKFILL_PROGRESS_SECONDS = 2
+
+# How often the channels and the calendars are reconciled
+RECONCILE_HOURS = 6
+# The maximum number of parameters in a single query
+QUERY_CHUNK_SIZE = 500
+
+
+@lru_cache()
+def _get_discovery_document() -> dict:
+    with open(DISCOVERY_DOCUMENT_PATH) as f:
+        return json.load(f)
+
+
+def _authorized_http(creds):
+    """ Return a new http object authorized with the credentials. """
+    import google_auth_httplib2
+    import httplib2
+
+    return google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http())
+
+
+def _save_credentials(guild_id: int, creds):
+    """ Pickle the credentials of the guild. The file is replaced atomically. """
+    os.makedirs(CREDS_DIR, exist_ok=True)
+
+    write_atomic(f'{CREDS_DIR}{guild_id}', pickle.dumps(creds))
+
+
+def _hash_body(body: dict) -> str:
+    return sha1(json.dumps(body, sort_keys=True).encode()).hexdigest()
+
+
+def _hash_item(item: dict) -> str:
+    """ Return the hash of the fields of a google API event which are set by Event.to_dict. """
+    return _hash_body({
+        # Google leaves out an empty summary
+        'summary': item.get('summary', ''),
+        'description': item.get('description'),
+        'start': {'date': item.get('start', {}).get('date')},
+        'end': {'date': item.get('end', {}).get('date')},
+    })
 
 
 @dataclass
@@ -34,6 +113,10 @@ class Event:
     description: str
     start_datetime: datetime.datetime
 
+    def content_hash(self) -> str:
+        """ Return a hash of the event body, equal for events which would look the same in the calendar. """
+        return _hash_body(self.to_dict())
+
     def to_dict(self):
         date = self.start_datetime.date().isoformat()
 
@@ -49,9 +132,81 @@ class Event:
         }
 
 
+@dataclass
+class SyncJob:
+    """
+    A change of a message to be synced to the calendar.
+
+    Attributes:
+        guild_id: The guild of the message.
+        channel_id: The channel of the message.
+        message_id: The message.
+        event: The event built from the message. None if the event of the message should be deleted.
+        attempts: The number of failed attempts to sync the job.
+    """
+    guild_id: int
+    channel_id: int
+    message_id: int
+    event: Optional[Event]
+    attempts: int = 0
+
+
+@dataclass
+class ReconcileReport:
+    """
+    The outcome of a reconciliation of a guild.
+
+    Attributes:
+        messages: The number of new messages gone through.
+        changed_events: The number of events changed in the calendar since the last reconciliation.
+        repaired: The number of events to be pushed again, because they were changed or deleted in the calendar.
+        dropped: The number of events whose messages no longer exist.
+    """
+    messages: int = 0
+    changed_events: int = 0
+    repaired: int = 0
+    dropped: int = 0
+
+
 class CalendarIntegration(Cog):
+    """
+    Syncs the exam messages to the google calendars of the guilds. Only the channels set with
+    `!conf calendar channel add` are synced.
+
+    The changes are synced in the background, so the event handlers never wait for the google API. A change is
+    synced `SYNC_DELAY` seconds after it was made, only the last of the changes made to a message meanwhile is synced.
+    The due changes are sent in per-guild batch requests.
+
+    Attributes:
+        http_factory: Returns a new http object for the given credentials, used to execute the requests. Can be
+            set on an instance to e.g. `lambda creds: HttpMockSequence(...)` to run without the network. A function
+            set on the class has to be wrapped in `staticmethod`.
+    """
+
+    http_factory: Callable[[Any], Any] = staticmethod(_authorized_http)
+
+    _services: Dict[int, 'Resource']  # guild_id: service
+    _building: Dict[int, asyncio.Task]  # guild_id: the task building or refreshing its service
+    _pending: Dict[int, SyncJob]  # message_id: the last change, which has not been synced yet
+    _queue: asyncio.Queue  # Ids of messages whose changes are due
+    _running: Set[int]  # Ids of messages being synced
+    _dispatcher: Optional[asyncio.Task] = None
+    _batches: Set[asyncio.Task]  # The batches being synced
+    _semaphore: asyncio.Semaphore  # Limits the batches running at once
+    _reconciling: Set[int]  # Ids of guilds being reconciled
+    _backfilling: Set[int]  # Ids of guilds being backfilled
+
     def __init__(self, bot: Marvin):
         self.bot = bot
+        self._services = {}
+        self._building = {}
+        self._pending = {}
+        self._queue = asyncio.Queue()
+        self._running = set()
+        self._batches = set()
+        self._semaphore = asyncio.Semaphore(SYNC_WORKERS)
+        self._reconciling = set()
+        self._backfilling = set()
 
         # Check for the secret file
         if not os.path.isfile(SECRET_FILENAME):
@@ -60,13 +215,30 @@ class CalendarIntegration(Cog):
             
             raise FileNotFoundError
 
-        # Connect DB
-        self.conn = sqlite3.connect('sqlite.db')
-        self.cursor = self.conn.cursor()
+        self.db = get_database()
+
+        self.bot.startup.add_step('calendar_sync', self._start_sync)
+
+    async def _start_sync(self):
+        # The channels have to be chosen explicitly, a calendar without them stays empty
+        for guild in self.bot.guilds:
+            if os.path.isfile(f'{CREDS_DIR}{guild.id}') and not await self._get_synced_channel_ids(guild.id):
+                logger.warning(f'The guild {guild.id} has set up the calendar, but no channels are synced. '
+                               f'Run `!conf calendar channel add` in the exam channels.')
 
-        # Create events table
-        with self.conn:
-            self.cursor.execute('create table if not exists events (message_id INTEGER, event_id TEXT)')
+        self._dispatcher = asyncio.ensure_future(self._dispatch())
+
+        # The first run catches up with the changes made while the bot was offline
+        self.reconcile_loop.start()
+
+    def cog_unload(self):
+        self.reconcile_loop.cancel()
+
+        if self._dispatcher:
+            self._dispatcher.cancel()
+
+        for task in self._batches:
+            task.cancel()
 
     @group()
     async def calendar(self, ctx: Context):
@@ -84,6 +256,9 @@ class CalendarIntegration(Cog):
         code back to Marvin and he will be ready to serve you!
         """
 
+        # Imported here, so the google client libraries are only loaded when needed
+        from google_auth_oauthlib.flow import InstalledAppFlow
+
         # Create the flow
         flow = InstalledAppFlow.from_client_secrets_file('secret.json',
                                                          scopes=['https://www.googleapis.com/auth/calendar.events'])
@@ -106,103 +281,717 @@ class CalendarIntegration(Cog):
             flow.fetch_token(code=code)
         except InvalidGrantError:
             await TimeoutMessage(ctx).send('**Invalid code. Please run the setup again!**')
+            return
+
+        # Store the credentials and drop the service using the old ones
+        _save_credentials(ctx.guild.id, flow.credentials)
+        self._services.pop(ctx.guild.id, None)
 
-        # Store the credentials
-        os.makedirs('creds/calendar', exist_ok=True)
-        with open(f'creds/calendar/{ctx.guild.id}', 'wb') as f:
-            pickle.dump(flow.credentials, f)
+        if not await self._get_synced_channel_ids(ctx.guild.id):
+            await TimeoutMessage(ctx).send('**Done!** Now run `!conf calendar channel add` in the channels whose exams '
+                                           'should be synced.')
+
+    @calendar.command()
+    @has_role('admin')
+    async def reconcile(self, ctx: Context):
+        """
+        Bring the calendar in line with the exam channels.
+
+        Goes through the messages posted since the last reconciliation and the events changed in the calendar since
+        then. Events deleted or changed in the calendar are pushed again. This is done periodically as well.
+
+        A newly synced channel is followed from its last message on, use `!calendar backfill` for the older exams.
+        """
+
+        if ctx.guild.id in self._reconciling:
+            await TimeoutMessage(ctx).send('**The calendar is already being reconciled.**')
+            return
+
+        self._reconciling.add(ctx.guild.id)
+        try:
+            async with ctx.typing():
+                report = await self.reconcile_guild(ctx.guild)
+        finally:
+            self._reconciling.discard(ctx.guild.id)
+
+        await ctx.send(f'**Reconciled!** New messages: {report.messages}, events changed in the calendar: '
+                       f'{report.changed_events}, repaired: {report.repaired}, dropped: {report.dropped}')
+
+    @calendar.command()
+    @has_role('admin')
+    async def backfill(self, ctx: Context, restart: str = None):
+        """
+        Push the upcoming exams already posted in the synced channels to the calendar.
+
+        Continues where the last backfill has stopped. Use `!calendar backfill restart` to go through the channels
+        from the beginning.
+        """
+
+        if ctx.guild.id in self._backfilling:
+            await TimeoutMessage(ctx).send('**The backfill is already running.**')
+            return
+
+        self._backfilling.add(ctx.guild.id)
+        try:
+            if not (channel_ids := await self._get_synced_channel_ids(ctx.guild.id)):
+                await TimeoutMessage(ctx).send('**No channels are synced.** Use `!conf calendar channel add` first.')
+                return
+
+            if restart == 'restart':
+                await self.db.execute(f'DELETE FROM backfill_checkpoints '
+                                      f'WHERE channel_id IN ({", ".join("?" * len(channel_ids))})', channel_ids)
+
+            progress = await ctx.send('**Backfilling ...**')
+            last_update = monotonic()
+            messages = exams = 0
+            failed = []  # The channels whose backfill stopped, because a page was not pushed
+
+            for channel_id in channel_ids:
+                async for page_messages, page_exams, pushed in self._backfill_channel(ctx.guild, channel_id):
+                    messages += page_messages
+                    exams += page_exams
+                    if not pushed:
+                        failed.append(channel_id)
+
+                    if monotonic() - last_update > BACKFILL_PROGRESS_SECONDS:
+                        await progress.edit(content=f'**Backfilling ...** Messages: {messages}, exams: {exams}')
+                        last_update = monotonic()
+
+            content = f'**Backfill {"incomplete" if failed else "done"}!** Messages: {messages}, exams: {exams}'
+            if failed:
+                content += ('\n⚠ Some exams could not be pushed in ' + ', '.join(f'<#{i}>' for i in failed)
+                            + '. Run the backfill again to continue there.')
+
+            await progress.edit(content=content)
+        finally:
+            self._backfilling.discard(ctx.guild.id)
 
     @staticmethod
-    def _get_service(guild_id: int):
+    def _build_service(guild_id: int, service=None):
+        """
+        Build the google calendar service from the stored credentials or refresh the credentials of the given service
+        if they have expired. Blocking.
+        """
+
+        if service is None:
+            with open(f'{CREDS_DIR}{guild_id}', 'rb') as f:
+                creds = pickle.load(f)
+        else:
+            # noinspection PyProtectedMember
+            creds = service._http.credentials
+
+        # Refresh the token and store it, so it does not need to be refreshed after a restart
+        if not creds.valid and creds.refresh_token:
+            from google.auth.transport.requests import Request
+
+            logger.debug(f'Refreshing the calendar credentials of the guild {guild_id}')
+            creds.refresh(Request())
+            _save_credentials(guild_id, creds)
+
+        if service is not None:
+            return service
+
+        # Imported here, so the google client libraries are only loaded when needed
+        from googleapiclient import discovery
+
+        return discovery.build_from_document(_get_discovery_document(), credentials=creds)
+
+    async def _get_service(self, guild_id: int):
         """ Get the google calendar service. Raise FileNotFound error if the credentials file is not found. """
-        # Get the credentials
-        with open(f'creds/calendar/{guild_id}', 'rb') as f:
-            creds = pickle.load(f)
+        service = self._services.get(guild_id)
+
+        # Only touch the disk and the network for a new service or expired credentials
+        # noinspection PyProtectedMember
+        if service is not None and service._http.credentials.valid:
+            return service
 
-        # Create the service
-        return discovery.build('calendar', 'v3', credentials=creds)
+        # Join the build in progress, concurrent refreshes of the same credentials would race writing them
+        if guild_id not in self._building:
+            self._building[guild_id] = asyncio.ensure_future(self._update_service(guild_id, service))
+
+        return await asyncio.shield(self._building[guild_id])
+
+    async def _update_service(self, guild_id: int, service):
+        try:
+            service = await self.bot.loop.run_in_executor(None, self._build_service, guild_id, service)
+            self._services[guild_id] = service
+
+            return service
+        finally:
+            del self._building[guild_id]
 
     @staticmethod
-    def _get_event_from_message(msg: Message) -> [None, Event]:
-        """ Build an Event instance from a message. """
+    def _get_event_from_embeds(embeds: List[Embed], upcoming_only: bool = False) -> [None, Event]:
+        """ Build an Event instance from the embeds of a message.
+
+        :param embeds: The embeds of the message.
+        :param upcoming_only: Ignore the messages dated in the past instead of moving them to the next year. Used for
+            the messages posted a while ago, whose dates are not meant to be in the future.
+        """
         # Ignore messages without embeds
-        if not msg.embeds:
+        if not embeds:
             return
 
-        emb = msg.embeds[0]
-        datetime_ = dateparser.parse(emb.description or '')
+        emb = embeds[0]
+        datetime_ = parse_date(emb.description)
 
         # Ignore messages without datetime
         if not datetime_:
             return
 
+        if upcoming_only and datetime_.date() < datetime.date.today():
+            return
+
         # Ensure the date is in the future
         if datetime_ < datetime.datetime.now():
             datetime_ = datetime_.replace(year=datetime_.year + 1)
 
-        # Prepare the event details
-        description = f'{emb.fields[0].name}\n{emb.fields[0].value}' if emb.fields else None
-        return Event(emb.title, description, datetime_)
+        # Prepare the event details, the missing embed parts are Embed.Empty, which cannot be serialized
+        field = emb.fields[0] if emb.fields else None
+        description = f'{field.name or ""}\n{field.value or ""}' if field else None
+        return Event(emb.title or '', description, datetime_)
+
+    @staticmethod
+    async def _get_synced_channel_ids(guild_id: Optional[int]) -> List[int]:
+        """ Return the ids of the channels whose exams are synced. Does not hit the db once the guild is cached. """
+        if guild_id is None:
+            return []
+
+        try:
+            return json.loads(await GuildConfig.get_by_guild_id(guild_id, 'calendar_channel_ids'))
+        except ValueError:
+            return []
+
+    async def _is_synced_channel(self, guild_id: Optional[int], channel_id: int) -> bool:
+        return channel_id in await self._get_synced_channel_ids(guild_id)
 
     @Cog.listener()
     async def on_message(self, msg: Message):
-        await self._sync_event(msg)
+        if not msg.embeds or not await self._is_synced_channel(msg.guild and msg.guild.id, msg.channel.id):
+            return
+
+        self._sync_event(msg.guild.id, msg.channel.id, msg.id, msg.embeds)
 
     @Cog.listener()
     async def on_raw_message_edit(self, payload: RawMessageUpdateEvent):
-        channel = await self.bot.fetch_channel(payload.data['channel_id'])
-        msg = await channel.fetch_message(payload.message_id)
+        data = payload.data
 
-        await self._sync_event(msg)
+        # Updates without an edit timestamp, such as link previews being added, and edits of messages without embeds
+        # are not interesting
+        if not data.get('edited_timestamp') or not data.get('embeds'):
+            return
+
+        guild_id = int(data['guild_id']) if 'guild_id' in data else None
+        if not await self._is_synced_channel(guild_id, payload.channel_id):
+            return
+
+        embeds = [Embed.from_dict(i) for i in data['embeds']]
+
+        # The embeds have not changed
+        cached = payload.cached_message
+        if cached and [i.to_dict() for i in cached.embeds] == [i.to_dict() for i in embeds]:
+            return
+
+        self._sync_event(guild_id, payload.channel_id, payload.message_id, embeds)
+
+    @Cog.listener()
+    async def on_raw_message_delete(self, payload: RawMessageDeleteEvent):
+        if await self._is_synced_channel(payload.guild_id, payload.channel_id):
+            self._schedule(SyncJob(payload.guild_id, payload.channel_id, payload.message_id, None))
+
+    def _sync_event(self, guild_id: int, channel_id: int, message_id: int, embeds: List[Embed]) -> bool:
+        """
+        Schedule creating an event in google calendar or updating an existing one assigned to the message. Return
+        whether the message is an exam.
+        """
+        if event := self._get_event_from_embeds(embeds):
+            self._schedule(SyncJob(guild_id, channel_id, message_id, event))
+
+        return event is not None
+
+    def _schedule(self, job: SyncJob, delay: float = SYNC_DELAY):
+        """ Queue the job after the delay. It replaces the job of the same message if there is any pending. """
+        if job.message_id not in self._pending:
+            self.bot.loop.call_later(delay, self._queue.put_nowait, job.message_id)
+
+        self._pending[job.message_id] = job
+
+    async def _dispatch(self):
+        """ Group the due jobs into per-guild batches and sync them, at most SYNC_WORKERS batches at once. """
+        while True:
+            message_ids = [await self._queue.get()]
+
+            # Let the jobs due at about the same time join the batch
+            await asyncio.sleep(BATCH_WINDOW)
+            while not self._queue.empty():
+                message_ids.append(self._queue.get_nowait())
+
+            batches: Dict[int, List[SyncJob]] = {}
+            for message_id in message_ids:
+                # Keep the jobs of a message in order, the next one waits until the current one is synced
+                if message_id in self._running:
+                    self.bot.loop.call_later(SYNC_DELAY, self._queue.put_nowait, message_id)
+                    continue
+
+                if job := self._pending.pop(message_id, None):
+                    self._running.add(message_id)
+                    batches.setdefault(job.guild_id, []).append(job)
+
+            for guild_id, jobs in batches.items():
+                for i in range(0, len(jobs), BATCH_SIZE):
+                    task = asyncio.ensure_future(self._run_batch(guild_id, jobs[i:i + BATCH_SIZE]))
+                    self._batches.add(task)
+                    task.add_done_callback(self._batches.discard)
+
+    async def _run_batch(self, guild_id: int, jobs: List[SyncJob]) -> bool:
+        """ Sync the jobs, whose messages have been marked as running, once a slot is free. Return whether it went
+        through. """
+        async with self._semaphore:
+            # noinspection PyBroadException
+            try:
+                await self._sync_batch(guild_id, jobs)
+            except Exception:
+                logger.error(f'Syncing {len(jobs)} messages of the guild {guild_id} failed!\n{format_exc()}')
+                return False
+            finally:
+                self._running.difference_update(job.message_id for job in jobs)
+
+        return True
+
+    async def _push(self, guild_id: int, jobs: List[SyncJob]) -> bool:
+        """
+        Sync the jobs right away and wait until they are done. The batches count towards the SYNC_WORKERS limit along
+        with the scheduled ones. Jobs of messages with a pending or running change are left to that change.
+
+        :return: Whether all the batches went through.
+        """
+
+        jobs = [job for job in jobs if job.message_id not in self._running and job.message_id not in self._pending]
+        self._running.update(job.message_id for job in jobs)
+
+        return all(await asyncio.gather(*[
+            self._run_batch(guild_id, jobs[i:i + BATCH_SIZE]) for i in range(0, len(jobs), BATCH_SIZE)
+        ]))
+
+    async def _execute(self, request, creds):
+        """
+        Execute the google API request or batch in an executor. Retry with an exponential backoff on transient
+        errors.
+        """
+        from googleapiclient.errors import HttpError
+
+        for attempt in range(MAX_ATTEMPTS):
+            # The http objects are not thread-safe, every request gets its own
+            http = self.http_factory(creds)
+
+            try:
+                return await self.bot.loop.run_in_executor(None, lambda: request.execute(http=http))
+            except HttpError as ex:
+                if ex.resp.status not in RETRY_STATUSES or attempt == MAX_ATTEMPTS - 1:
+                    raise
+
+                delay = BACKOFF_SECONDS * 2 ** attempt * (1 + random())
+                logger.warning(f'Google API responded with {ex.resp.status}, retrying in {delay:.1f} s')
+                await asyncio.sleep(delay)
+
+    async def _execute_batch(self, service, requests: Dict[int, 'HttpRequest']) -> Dict[int, Tuple[Any, Exception]]:
+        """
+        Execute the requests in a single batch.
+
+        :param service: The calendar service the requests were made with.
+        :param requests: message_id: request pairs.
+        :return: message_id: (response, exception) pairs. The exception is None if the request succeeded.
+        """
+
+        results = {}
+        if not requests:
+            return results
+
+        def callback(request_id: str, response, exception: Exception):
+            results[int(request_id)] = response, exception
+
+        batch = service.new_batch_http_request(callback=callback)
+        for message_id, request in requests.items():
+            batch.add(request, request_id=str(message_id))
+
+        # noinspection PyProtectedMember
+        await self._execute(batch, getattr(service._http, 'credentials', None))
+
+        return results
+
+    def _retry_later(self, job: SyncJob, exception: Exception):
+        """ Schedule the failed job again if the error is transient, unless a newer change is pending. """
+        status = getattr(getattr(exception, 'resp', None), 'status', None)
 
-    async def _sync_event(self, msg: Message):
-        """ Create an event in google calendar or update an existing one assigned to the message. """
-        if not (event := self._get_event_from_message(msg)):
+        if status not in RETRY_STATUSES or job.attempts + 1 >= MAX_ATTEMPTS:
+            logger.error(f'Syncing the message {job.message_id} failed: {exception}')
             return
 
-        # Look in the database for an event id assigned to the message
-        self.cursor.execute('SELECT * FROM events WHERE message_id = ?', (msg.id,))
-        _, event_id = self.cursor.fetchone() or (None, None)  # message_id, event_id
+        if job.message_id not in self._pending:
+            job.attempts += 1
+            self._schedule(job, BACKOFF_SECONDS * 2 ** job.attempts * (1 + random()))
+
+    async def _sync_batch(self, guild_id: int, jobs: List[SyncJob]):
+        """ Create, update or delete the events of the messages using a batch request. """
+        # Look in the database for the event ids assigned to the messages and the hashes of the pushed events
+        message_ids = [job.message_id for job in jobs]
+        rows = await self.db.execute(f'SELECT message_id, event_id, content_hash FROM events '
+                                     f'WHERE message_id IN ({", ".join("?" * len(message_ids))})', message_ids)
+        event_ids: Dict[int, str] = {row['message_id']: row['event_id'] for row in rows}
+        hashes: Dict[int, str] = {row['message_id']: row['content_hash'] for row in rows}
+
+        # Nothing to delete and the events which are up to date
+        jobs = [job for job in jobs if (job.message_id in event_ids if job.event is None
+                                        else job.event.content_hash() != hashes.get(job.message_id))]
+        if not jobs:
+            return
 
-        calendar_id = GuildConfig.get_by_guild_id(msg.guild.id, 'calendar_id')
+        calendar_id = await GuildConfig.get_by_guild_id(guild_id, 'calendar_id')
 
         try:
-            service = self._get_service(msg.guild.id)
+            service = await self._get_service(guild_id)
         except FileNotFoundError:
-            logger.info(f'Credentials file for the guild {msg.guild.id} not found!')
+            logger.info(f'Credentials file for the guild {guild_id} not found!')
             return
 
-        if not event_id:
-            event = service.events().insert(calendarId=calendar_id, body=event.to_dict()).execute()
-            logger.info('Event created: ' + event.get('htmlLink'))
+        events = service.events()
+
+        # Prepare the changes
+        requests = {}
+        for job in jobs:
+            event_id = event_ids.get(job.message_id)
+
+            if job.event is None:
+                requests[job.message_id] = events.delete(calendarId=calendar_id, eventId=event_id)
+            elif event_id is None:
+                requests[job.message_id] = events.insert(calendarId=calendar_id, body=job.event.to_dict())
+            else:
+                # Only the fields of the body are changed, the ones set in the calendar are kept
+                requests[job.message_id] = events.patch(calendarId=calendar_id, eventId=event_id,
+                                                        body=job.event.to_dict())
+
+        results = await self._execute_batch(service, requests)
+
+        # Map the results back to the database
+        pushed, deleted = [], []
+        for job in jobs:
+            response, exception = results.get(job.message_id, (None, None))
+            status = getattr(getattr(exception, 'resp', None), 'status', None)
+
+            if job.event is None and (exception is None or status in (404, 410)):
+                deleted.append((job.message_id,))
+            elif exception:
+                self._retry_later(job, exception)
+            elif response:
+                if job.message_id not in event_ids:
+                    logger.info('Event created: ' + response.get('htmlLink'))
+
+                pushed.append((job.message_id, response['id'], job.event.content_hash(), job.channel_id))
+
+        if pushed:
+            await self.db.executemany('INSERT OR REPLACE INTO events (message_id, event_id, content_hash, channel_id) '
+                                      'VALUES (?, ?, ?, ?)', pushed)
+        if deleted:
+            await self.db.executemany('DELETE FROM events WHERE message_id = ?', deleted)
+
+    # noinspection PyCallingNonCallable
+    @tasks.loop(hours=RECONCILE_HOURS)
+    async def reconcile_loop(self):
+        for guild in self.bot.guilds:
+            if guild.id in self._reconciling:
+                continue
+
+            self._reconciling.add(guild.id)
+            # noinspection PyBroadException
+            try:
+                if not await self._get_synced_channel_ids(guild.id):
+                    continue
+
+                report = await self.reconcile_guild(guild)
+            except Exception:
+                logger.error(f'Reconciling the guild {guild.id} failed!\n{format_exc()}')
+            else:
+                logger.info(f'Reconciled the guild {guild.id}: {report}')
+            finally:
+                self._reconciling.discard(guild.id)
+
+    async def reconcile_guild(self, guild: Guild) -> ReconcileReport:
+        """
+        Sync the messages posted since the last run and repair the events changed or deleted in the calendar since the
+        last run. The events of messages deleted while the bot was offline are not detected.
 
-            # Add the event into the database
-            with self.conn:
-                self.cursor.execute('insert into events values (?, ?)', (msg.id, event['id']))
+        The caller marks the guild in `_reconciling` before it awaits anything, so a guild is never reconciled twice
+        at once.
+        """
 
-        else:
-            event_data = service.events().get(calendarId=calendar_id, eventId=event_id).execute()
-            event_data.update(event.to_dict())
+        report = ReconcileReport()
 
-            service.events().update(calendarId=calendar_id, eventId=event_id, body=event_data).execute()
+        try:
+            service = await self._get_service(guild.id)
+        except FileNotFoundError:
+            logger.info(f'Credentials file for the guild {guild.id} not found!')
+            return report
+
+        calendar_id = await GuildConfig.get_by_guild_id(guild.id, 'calendar_id')
+        channel_ids = await self._get_synced_channel_ids(guild.id)
+
+        # Calendar side
+        items, sync_token, full = await self._list_changed_events(guild.id, service, calendar_id)
+        report.changed_events = len(items)
+        jobs = await self._repair_events(guild, channel_ids, items, full, report)
+
+        # Channel side
+        cursors = []
+        for channel_id in channel_ids:
+            cursor, channel_jobs = await self._sync_new_messages(guild, channel_id, report)
+            jobs += channel_jobs
+            if cursor:
+                cursors.append((channel_id, cursor))
+
+        # Store the progress only once the changes have been pushed, otherwise the next run goes through them again
+        if not await self._push(guild.id, jobs):
+            logger.warning(f'Some changes of the guild {guild.id} were not pushed, they will be reconciled again.')
+            return report
+
+        await self.db.run(lambda conn: (
+            conn.execute('INSERT OR REPLACE INTO calendar_sync_tokens VALUES (?, ?)', (guild.id, sync_token)),
+            conn.executemany('INSERT OR REPLACE INTO channel_cursors VALUES (?, ?)', cursors)
+        ), 'store the reconciliation progress')
+
+        return report
+
+    async def _list_changed_events(self, guild_id: int, service, calendar_id: str) -> Tuple[Dict[str, dict], str, bool]:
+        """
+        List the events changed since the last reconciliation, including the deleted ones, using the stored sync token.
+        All the events are listed if there is no token or it has expired.
 
-    @Cog.listener()
-    async def on_raw_message_delete(self, payload: RawMessageDeleteEvent):
-        # Look in the database whether an event for the message already exists
-        self.cursor.execute('SELECT * FROM events WHERE message_id = ?', (payload.message_id,))
-        _, event_id = self.cursor.fetchone() or (None, None)  # message_id, event_id
+        :return: event_id: event pairs, the next sync token and whether all the events were listed.
+        """
+        from googleapiclient.errors import HttpError
+
+        row = await self.db.fetchone('SELECT sync_token FROM calendar_sync_tokens WHERE guild_id = ?', (guild_id,))
+        sync_token = row and row['sync_token']
+
+        # noinspection PyProtectedMember
+        creds = getattr(service._http, 'credentials', None)
+        items, page_token = {}, None
+
+        while True:
+            kwargs = {'syncToken': sync_token} if sync_token else {}
+            request = service.events().list(calendarId=calendar_id, showDeleted=True, maxResults=2500,
+                                            pageToken=page_token, **kwargs)
 
-        if event_id:
             try:
-                service = self._get_service(payload.guild_id)
-            except FileNotFoundError:
-                logger.info(f'Credentials file for the guild {payload.guild_id} not found!')
-                return
+                response = await self._execute(request, creds)
+            except HttpError as ex:
+                if ex.resp.status != 410 or not sync_token:
+                    raise
+
+                # The token has expired, list everything
+                logger.info(f'The calendar sync token of the guild {guild_id} has expired.')
+                sync_token, items, page_token = None, {}, None
+                continue
+
+            items.update((item['id'], item) for item in response.get('items', []))
+
+            if not (page_token := response.get('nextPageToken')):
+                return items, response['nextSyncToken'], sync_token is None
+
+    async def _repair_events(self, guild: Guild, channel_ids: List[int], items: Dict[str, dict], full: bool,
+                             report: ReconcileReport) -> List[SyncJob]:
+        """
+        Prepare pushing the events changed or deleted in the calendar again. Drop the ones whose messages are gone.
+
+        :return: The jobs repairing the events.
+        """
+
+        jobs = []
+        # Our events, which were changed in the calendar. All of them if the whole calendar was listed.
+        if full:
+            # Events pushed before the channel was stored can only be told apart by being present in the calendar
+            guild_channel_ids = {channel.id for channel in guild.channels}
+            rows = [row for row in await self.db.execute('SELECT * FROM events')
+                    if row['channel_id'] in guild_channel_ids or row['channel_id'] is None and row['event_id'] in items]
+        else:
+            event_ids, rows = list(items), []
+            for i in range(0, len(event_ids), QUERY_CHUNK_SIZE):
+                chunk = event_ids[i:i + QUERY_CHUNK_SIZE]
+                rows += await self.db.execute(f'SELECT * FROM events '
+                                              f'WHERE event_id IN ({", ".join("?" * len(chunk))})', chunk)
+
+        for row in rows:
+            item = items.get(row['event_id'])
+            deleted = item is None or item.get('status') == 'cancelled'
+
+            # Our own changes come back unchanged
+            if not deleted and _hash_item(item) == row['content_hash']:
+                continue
+
+            # Find the message, the channel was not stored before the reconciliation was introduced
+            msg = None
+            for channel_id in [row['channel_id']] if row['channel_id'] else channel_ids:
+                if channel := guild.get_channel(channel_id):
+                    try:
+                        msg = await channel.fetch_message(row['message_id'])
+                        break
+                    except NotFound:
+                        pass
+
+            if msg is None or not self._get_event_from_embeds(msg.embeds):
+                # Delete the event, or only the row if the event is deleted already
+                if deleted:
+                    await self.db.execute('DELETE FROM events WHERE message_id = ?', (row['message_id'],))
+                else:
+                    jobs.append(SyncJob(guild.id, row['channel_id'], row['message_id'], None))
+                report.dropped += 1
+                continue
+
+            # Past exams are left as they are, only the row of a deleted event is dropped
+            if not (event := self._get_event_from_embeds(msg.embeds, upcoming_only=True)):
+                if deleted:
+                    await self.db.execute('DELETE FROM events WHERE message_id = ?', (msg.id,))
+                continue
+
+            # Forget the pushed event, so it is inserted or patched again
+            if deleted:
+                await self.db.execute('DELETE FROM events WHERE message_id = ?', (msg.id,))
+            else:
+                await self.db.execute('UPDATE events SET content_hash = NULL WHERE message_id = ?', (msg.id,))
+
+            jobs.append(SyncJob(guild.id, msg.channel.id, msg.id, event))
+            report.repaired += 1
+
+        return jobs
+
+    async def _sync_new_messages(self, guild: Guild, channel_id: int,
+                                 report: ReconcileReport) -> Tuple[Optional[int], List[SyncJob]]:
+        """
+        Prepare syncing the messages posted in the channel since the last reconciliation. A channel seen for the first
+        time starts at its last message, the older messages are left to `!calendar backfill`.
+
+        :return: The new cursor and the jobs syncing the exams.
+        """
+
+        if not (channel := guild.get_channel(channel_id)):
+            return None, []
+
+        if not (row := await self.db.fetchone('SELECT message_id FROM channel_cursors WHERE channel_id = ?',
+                                              (channel_id,))):
+            return channel.last_message_id, []
+
+        cursor, jobs = row['message_id'], []
+        async for msg in channel.history(limit=None, after=Object(cursor), oldest_first=True):
+            report.messages += 1
+            cursor = msg.id
+
+            if event := self._get_event_from_embeds(msg.embeds, upcoming_only=True):
+                jobs.append(SyncJob(guild.id, channel_id, msg.id, event))
+
+        return cursor, jobs
+
+    async def _backfill_channel(self, guild: Guild, channel_id: int) -> AsyncGenerator[Tuple[int, int, bool], None]:
+        """
+        Push the exams of the channel page by page, starting after the checkpoint. The checkpoint is moved once a page
+        has been pushed, so an interrupted backfill can be resumed. The channel is left at the first page which was
+        not pushed.
+
+        :return: An async generator yielding the numbers of messages and exams of each page and whether it was pushed.
+        """
+
+        if not (channel := guild.get_channel(channel_id)):
+            return
 
-            calendar_id = GuildConfig.get_by_guild_id(payload.guild_id, 'calendar_id')
-            service.events().delete(calendarId=calendar_id, eventId=event_id).execute()
+        row = await self.db.fetchone('SELECT message_id FROM backfill_checkpoints WHERE channel_id = ?', (channel_id,))
+        history = channel.history(limit=None, after=row and Object(row['message_id']), oldest_first=True)
+
+        with ThreadPoolExecutor(BACKFILL_PARSERS, thread_name_prefix='Backfill') as pool:
+            while page := await self._next_page(history):
+                # Parse the dates off the event loop
+                events = await asyncio.gather(*[
+                    self.bot.loop.run_in_executor(pool, self._get_event_from_embeds, msg.embeds, True) for msg in page
+                ])
+
+                jobs = [SyncJob(guild.id, channel_id, msg.id, event) for msg, event in zip(page, events) if event]
+
+                # Keep the checkpoint, so the next backfill goes through the page again
+                if not await self._push(guild.id, jobs):
+                    logger.warning(f'Backfilling the channel {channel_id} stopped, some exams were not pushed.')
+                    yield len(page), len(jobs), False
+                    return
+
+                await self.db.execute('INSERT OR REPLACE INTO backfill_checkpoints VALUES (?, ?)',
+                                      (channel_id, page[-1].id))
+
+                yield len(page), len(jobs), True
+
+    @staticmethod
+    async def _next_page(history) -> List[Message]:
+        """ Take the next BACKFILL_PAGE_SIZE messages with embeds from the history iterator. """
+        page = []
+
+        async for msg in history:
+            if msg.embeds:
+                page.append(msg)
+
+            if len(page) == BACKFILL_PAGE_SIZE:
+                break
+
+        return page
 
 
 def setup(bot: Marvin):
     cog = CalendarIntegration(bot)
     bot.add_cog(cog)
+
+
+if __name__ == '__main__':
+    # Run from the repository root with `PYTHONPATH=src python -m cogs.calendar_integration`, no network is used
+    import tempfile
+    from types import SimpleNamespace
+
+    from googleapiclient import discovery
+    from googleapiclient.http import HttpMockSequence
+
+    from database import Database
+
+    def _part(message_id: int, status: str, body: dict = None) -> str:
+        return (f'--batch\r\nContent-Type: application/http\r\nContent-ID: <response-test + {message_id}>\r\n\r\n'
+                f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\n\r\n{json.dumps(body) if body else ""}\r\n')
+
+    async def _test_sync_batch():
+        _event = Event('Math', 'Monday, 1. March 2021', datetime.datetime(2021, 3, 1))
+        _changed = Event('Math', 'Tuesday, 2. March 2021', datetime.datetime(2021, 3, 2))
+
+        # 1 is new, 2 has changed, 3 is deleted, 4 is deleted and gone from the calendar already
+        _http = HttpMockSequence([({'status': '200', 'content-type': 'multipart/mixed; boundary=batch'}, (
+            _part(1, '200 OK', {'id': 'e1', 'htmlLink': 'link'}) + _part(2, '200 OK', {'id': 'e2'})
+            + _part(3, '204 No Content') + _part(4, '404 Not Found', {'error': {'code': 404}}) + '--batch--'))])
+
+        cog = CalendarIntegration.__new__(CalendarIntegration)
+        cog.bot = SimpleNamespace(loop=asyncio.get_event_loop())
+        cog.db = Database(os.path.join(tempfile.mkdtemp(), 'sqlite.db'))
+        cog.http_factory = lambda creds: _http
+        _service = discovery.build_from_document(_get_discovery_document(), http=_http)
+
+        async def _get_service(guild_id: int):
+            return _service
+
+        cog._get_service = _get_service
+        GuildConfig._rows[0] = {'calendar_id': 'calendar'}
+
+        await cog.db.executemany('INSERT INTO events (message_id, event_id, content_hash, channel_id) VALUES '
+                                 '(?, ?, ?, 0)', [(2, 'e2', _event.content_hash()), (3, 'e3', ''), (4, 'e4', '')])
+        await cog._sync_batch(0, [SyncJob(0, 0, 1, _event), SyncJob(0, 0, 2, _changed), SyncJob(0, 0, 3, None),
+                                  SyncJob(0, 0, 4, None)])
+
+        _body = _http.request_sequence[0][2]
+        assert 'POST /calendar/v3/calendars/calendar/events' in _body
+        assert 'PATCH /calendar/v3/calendars/calendar/events/e2' in _body
+        assert 'DELETE /calendar/v3/calendars/calendar/events/e3' in _body
+
+        rows = await cog.db.execute('SELECT message_id, event_id, content_hash FROM events ORDER BY message_id')
+        assert [tuple(i) for i in rows] == [(1, 'e1', _event.content_hash()), (2, 'e2', _changed.content_hash())]
+
+        cog.db.close()
+
+    asyncio.get_event_loop().run_until_complete(_test_sync_batch())
@@ -1,5 +1,5 @@
 import logging
-from asyncio import sleep
+from asyncio import gather, sleep
 
 from discord import Embed, Message, RawReactionActionEvent, TextChannel
 from discord.errors import NotFound
@@ -30,8 +30,9 @@ class CommandPanel(Cog):
     def __init__(self, bot: Marvin):
         self.bot = bot
 
-    @Cog.listener()
-    async def on_ready(self):
+        self.bot.startup.add_step('command_panel', self._startup)
+
+    async def _startup(self):
         # Get the channel
         channel_id = self.bot.store.command_panel_channel_id
         self._channel = self.bot.get_channel(channel_id)
@@ -46,7 +47,7 @@ class CommandPanel(Cog):
         # Adopt the embed
         async for msg in self._channel.history():
             if msg.embeds and msg.embeds[0].to_dict() == embed.to_dict():
-                self._msg = await self._channel.fetch_message(msg.id)
+                self._msg = msg
                 logger.debug(f'Adopted message {msg.id}')
                 break
         else:
@@ -62,16 +63,12 @@ class CommandPanel(Cog):
     async def reset_reactions(self):
         logger.debug('Resetting reactions ...')
 
-        # Clear not desired reactions
-        added_emojis = []
-        for reaction in self._msg.reactions:
-            if reaction.emoji not in EMOJI_COMMAND_MAP:
-                async for user in reaction.users():
-                    await self._msg.remove_reaction(reaction.emoji, user)
-            else:
-                added_emojis.append(reaction.emoji)
+        # Clear not desired reactions, one request per emoji
+        added_emojis = [i.emoji for i in self._msg.reactions if i.emoji in EMOJI_COMMAND_MAP]
+        await gather(*[self._msg.clear_reaction(i.emoji) for i in self._msg.reactions
+                       if i.emoji not in EMOJI_COMMAND_MAP])
 
-        # Add missing reactions
+        # Add missing reactions. Kept sequential, so the reactions stay in order
         for emoji in EMOJI_COMMAND_MAP:
             if emoji not in added_emojis:
                 await self._msg.add_reaction(emoji)
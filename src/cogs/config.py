@@ -1,53 +1,80 @@
-import sqlite3
-from typing import Any, List
+import json
+from typing import Any, Dict, List, Set
 
 from discord.ext.commands import Cog, Context, group, has_role
 
+from database import get_database
+
 
 class GuildConfig:
-    conn = sqlite3.connect('sqlite.db')
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+    """
+    The per-guild configuration stored in the `guild_config` table.
+
+    The rows are cached in memory once read, so the lookups on the hot paths do not hit the db. A cached row is
+    dropped whenever it is written to.
+
+    Attributes:
+        columns: The names of the columns which can be set, read from the table on the first use.
+    """
+
+    columns: Set[str] = set()
+    _rows: Dict[int, dict] = {}  # guild_id: row
+    _ready = False
+
+    @classmethod
+    async def _prepare(cls):
+        """ Read the columns of the table on the first use. The table is created by the db migrations. """
+        if cls._ready:
+            return
 
-    # Create table
-    cursor.execute('CREATE TABLE IF NOT EXISTS guild_config('
-                   'id INTEGER PRIMARY KEY,'
-                   'calendar_id TEXT DEFAULT "primary"'
-                   ')')
+        rows = await get_database().execute('PRAGMA table_info(guild_config)')
+        cls.columns = {row['name'] for row in rows} - {'id'}
+        cls._ready = True
 
     @classmethod
-    def add_guilds(cls, guild_ids: List[int]):
+    async def add_guilds(cls, guild_ids: List[int]):
         """ Call this method in order to make sure a config row for each guild is created in the db."""
-        for id_ in guild_ids:
-            cls.cursor.execute(f'INSERT OR IGNORE INTO guild_config (id) VALUES ({id_})')
-        cls.conn.commit()
+        await cls._prepare()
+        await get_database().executemany('INSERT OR IGNORE INTO guild_config (id) VALUES (?)',
+                                          [(id_,) for id_ in guild_ids])
 
     @classmethod
-    def get(cls, ctx: Context, key: str):
+    async def get(cls, ctx: Context, key: str):
         """ A shortcut for get_by_guild_id. """
-        return cls.get_by_guild_id(ctx.guild.id, key)
+        return await cls.get_by_guild_id(ctx.guild.id, key)
 
     @classmethod
-    def get_by_guild_id(cls, guild_id: int, key: str):
+    async def get_by_guild_id(cls, guild_id: int, key: str):
         """ Get the value of the key for the server specified by the guild_id. """
-        cls.cursor.execute('SELECT * FROM guild_config WHERE id=?', (guild_id,))
-        entry = cls.cursor.fetchone()
+        row = cls._rows.get(guild_id)
+
+        if row is None:
+            await cls._prepare()
+            entry = await get_database().fetchone('SELECT * FROM guild_config WHERE id=?', (guild_id,))
+
+            if entry is None:
+                raise ValueError(f'Config for the guild {guild_id} not found!')
 
-        if entry is None:
-            raise ValueError(f'Config for the guild {guild_id} not found!')
+            row = cls._rows[guild_id] = dict(entry)
 
-        return entry[key]
+        return row[key]
 
     @classmethod
-    def set(cls, ctx: Context, key: str, value: Any):
+    async def set(cls, ctx: Context, key: str, value: Any):
         """ A shortcut for set_by_guild_id. """
-        cls.set_by_guild_id(ctx.guild.id, key, value)
+        await cls.set_by_guild_id(ctx.guild.id, key, value)
 
     @classmethod
-    def set_by_guild_id(cls, guild_id: int, key: str, value: Any):
+    async def set_by_guild_id(cls, guild_id: int, key: str, value: Any):
         """ Set the value of the key for the server specified by the guild_id. """
-        with cls.conn:
-            cls.cursor.execute(f'UPDATE guild_config SET {key}="{value}" WHERE id={guild_id}')
+        await cls._prepare()
+        if key not in cls.columns:
+            raise ValueError(f'{key} is not a guild config key!')
+
+        # The column name cannot be a parameter, it is checked against the table columns above
+        await get_database().execute(f'UPDATE guild_config SET {key}=? WHERE id=?', (value, guild_id))
+
+        cls._rows.pop(guild_id, None)
 
 
 class ConfigCog(Cog):
@@ -75,13 +102,40 @@ class ConfigCog(Cog):
 
         if calendar_id is None:
             await ctx.send(
-                f'The value of the key **calendar_id** is `{GuildConfig.get(ctx, "calendar_id")}` '
+                f'The value of the key **calendar_id** is `{await GuildConfig.get(ctx, "calendar_id")}` '
                 f'for your server.')
 
         else:
-            GuildConfig.set(ctx, 'calendar_id', calendar_id)
+            await GuildConfig.set(ctx, 'calendar_id', calendar_id)
             await self._confirm_change(ctx)
 
+    @calendar.command()
+    async def channel(self, ctx: Context, action: str = None):
+        """
+        Set the channels whose exams are synced to the calendar.
+
+        Use `add` in order to sync the exams posted in this channel or `remove` to stop syncing them. The synced
+        channels are listed if no action is given.
+        """
+
+        channel_ids: List[int] = json.loads(await GuildConfig.get(ctx, 'calendar_channel_ids'))
+
+        if action is None:
+            channels = ', '.join(f'<#{id_}>' for id_ in channel_ids) or 'none'
+            await ctx.send(f'The channels synced to the calendar are: {channels}')
+            return
+
+        if action == 'add' and ctx.channel.id not in channel_ids:
+            channel_ids.append(ctx.channel.id)
+        elif action == 'remove' and ctx.channel.id in channel_ids:
+            channel_ids.remove(ctx.channel.id)
+        elif action not in ('add', 'remove'):
+            await ctx.send('The action has to be either `add` or `remove`.')
+            return
+
+        await GuildConfig.set(ctx, 'calendar_channel_ids', json.dumps(channel_ids))
+        await self._confirm_change(ctx)
+
 
 def setup(bot):
     bot.add_cog(ConfigCog())
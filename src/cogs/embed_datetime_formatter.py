@@ -1,8 +1,8 @@
 from discord.ext.commands import Cog
 from discord import Message, Embed
-import dateparser
 
 from client import Marvin
+from dates import parse_date
 
 
 class EmbedDatetimeFormatter(Cog):
@@ -29,7 +29,7 @@ class EmbedDatetimeFormatter(Cog):
         if embed.description == Embed.Empty:
             return
 
-        date = dateparser.parse(embed.description, settings={'PREFER_DATES_FROM': 'future'})
+        date = parse_date(embed.description, PREFER_DATES_FROM='future')
 
         if date is None:
             return
@@ -43,11 +43,20 @@ class EmoteCog(Cog, name='Emotes'):
 
         self.bot.add_listener(self.on_message)
 
+        self.bot.startup.add_step('emotes', self._startup)
+
+    async def _startup(self):
+        await self.reload_emotes()
         self.reload_emotes_loop.start()
 
     # noinspection PyCallingNonCallable
     @tasks.loop(minutes=60)
-    async def reload_emotes_loop(self, force=False):
+    async def reload_emotes_loop(self):
+        # The first load is done by the startup step
+        if self.reload_emotes_loop.current_loop:
+            await self.reload_emotes()
+
+    async def reload_emotes(self):
         logger.info('Loading emotes ...')
 
         # Emotes from remote servers
@@ -119,7 +128,7 @@ class EmoteCog(Cog, name='Emotes'):
     @emote.command(hidden=True)
     @del_invoc
     async def reload(self, ctx: Context):
-        await self.reload_emotes_loop.coro(self, True)
+        await self.reload_emotes()
         await TimeoutMessage(ctx).send('✅ Emotes have been successfully reloaded.')
 
     @emote.command()
@@ -1,4 +1,4 @@
-from typing import List, Tuple
+from typing import List, Set, Tuple
 
 from discord import Game, Status
 from discord.ext.commands import Cog
@@ -6,6 +6,7 @@ from discord.ext.tasks import loop
 
 from client import Marvin
 from remote_config import RemoteConfig
+from startup import REMOTE_CONFIG
 
 
 class PresenceCycler(Cog):
@@ -16,15 +17,20 @@ class PresenceCycler(Cog):
         self.bot = bot
         self.presences = []
 
-        self.bot.add_listener(self.restart, 'on_ready')
+        self.bot.startup.add_step('presence', self.restart, requires=[REMOTE_CONFIG])
 
     async def restart(self):
         # We are gonna retrieve the presence list here
-        self.presences = RemoteConfig.presences
+        self.presences = list(RemoteConfig.presences)
 
         # Restart the loop
         self.loop.start()
 
+    @Cog.listener()
+    async def on_remote_config_change(self, keys: Set[str]):
+        if 'presences' in keys:
+            self.presences = list(RemoteConfig.presences)
+
     # noinspection PyCallingNonCallable
     @loop(seconds=10)
     async def loop(self):
@@ -5,7 +5,7 @@ import traceback
 from dataclasses import dataclass
 from datetime import datetime
 from io import BytesIO
-from typing import Optional
+from typing import Optional, Tuple
 
 import PIL.ImageOps
 import bs4
@@ -14,18 +14,22 @@ from PIL.Image import Image
 from discord import File
 from discord.ext import tasks
 from discord.ext.commands import Cog, Context, command
-from pdf2image import pdf2image
 
+from blob_store import BlobStore
 from cache import Cache
 from client import Marvin
 from command_output import CommandOutput
 from decorators import del_invoc
 from remote_config import RemoteConfig
+from startup import REMOTE_CONFIG
 from utils import ImageUtils
+from utils.error import send_error
 from config import Config
 
 BG_COLOR = (35, 39, 42)
-CACHE_KEY = 'substits'
+CACHE_KEY = 'substits_blob'
+# Marks the images in the BlobStore
+BLOB_SOURCE = 'substits'
 CACHE_SECONDS = 600
 ATTACHMENT_FILENAME = 'substits.png'
 
@@ -109,7 +113,7 @@ def enhance_image(img: Image) -> Image:
 class Substits(Cog, name='Substitutions'):
     bot: Marvin
     _date: str  # User will be informed about the date of the pdf
-    _image: Image
+    _digest: Optional[str] = None  # The BlobStore digest of the rendered PNG
 
     def __init__(self, bot: Marvin):
         self.bot = bot
@@ -117,28 +121,45 @@ class Substits(Cog, name='Substitutions'):
 
         # Start loop
         if Config.moodle_username and Config.moodle_password:
-            self.bot.add_listener(self.on_ready)
+            self.bot.startup.add_step('substits', self._startup, requires=[REMOTE_CONFIG])
         else:
             logger.info(
                 'Skipping substitutions scraping as no valid moodle credentials are provided.')
 
-    async def on_ready(self):
+    async def _startup(self):
+        await self.load_data()
         self.reload_data.start()
 
     # noinspection PyCallingNonCallable
     @tasks.loop(seconds=CACHE_SECONDS)
     async def reload_data(self):
-        # Do not download if cached data is unexpired
-        # Used when bot restarts frequently
-
-        # Load cached
-        cached = Cache.load(CACHE_KEY, CACHE_SECONDS)
-        if cached:
-            self._date, _bytes = cached
-            self._image = PIL.Image.open(BytesIO(_bytes))
-            logger.debug('Loaded cached images')
+        # The first load is done by the startup step
+        if self.reload_data.current_loop:
+            await self.load_data()
+
+    async def load_data(self):
+        # The cached data is used when the bot restarts frequently
+        cached = await Cache.get_or_compute(CACHE_KEY, CACHE_SECONDS, self.download_data)
+        if not cached:
             return
 
+        date, digest = cached
+        if not BlobStore.exists(digest):
+            logger.warning(f'The cached image {digest} is missing from the blob store!')
+            return
+
+        replaced = digest != self._digest
+        self._date, self._digest = date, digest
+        logger.debug('Loaded the images')
+
+        # Drop the replaced images, including the ones stored before a restart. Only once the new image is served,
+        # so the command never opens a removed blob.
+        if replaced:
+            await self.bot.loop.run_in_executor(None, lambda: BlobStore.remove_stale(digest, source=BLOB_SOURCE))
+
+    async def download_data(self) -> Optional[Tuple[str, str]]:
+        """ Download the pdf and render it. Return the date of the pdf and the digest of the PNG or None if failed. """
+
         # Download
         kwargs = RemoteConfig.substits_kwargs
         args = kwargs['login_url'], kwargs['course_url'], kwargs[
@@ -152,12 +173,16 @@ class Substits(Cog, name='Substitutions'):
             return
 
         # Save date
-        self._date = date_from_pdf_name(result.filename)
+        date = date_from_pdf_name(result.filename)
 
         logger.debug('Done')
 
         # Convert pdf to images
         logger.debug('Converting to images...')
+
+        # Imported here, so pdf2image is only loaded when there is something to convert
+        from pdf2image import pdf2image
+
         try:
             ims = pdf2image.convert_from_bytes(
                 result.data, fmt='png', transparent=True)
@@ -188,12 +213,14 @@ class Substits(Cog, name='Substitutions'):
         im = im.crop(im.getbbox())
 
         # Make the image look nicer
-        self._image = enhance_image(im)
+        im = enhance_image(im)
 
-        # Cache
         buffer = BytesIO()
-        self._image.save(buffer, 'PNG')
-        Cache.cache(CACHE_KEY, (self._date, buffer.getvalue()))
+        im.save(buffer, 'PNG')
+        digest = await self.bot.loop.run_in_executor(
+            None, lambda: BlobStore.put(buffer.getvalue(), content_type='image/png', date=date, source=BLOB_SOURCE))
+
+        return date, digest
 
     @command(aliases=['supl', 'suply', 'sub'])
     @del_invoc
@@ -204,20 +231,20 @@ class Substits(Cog, name='Substitutions'):
         The last pdf file from the remote-configured course is pulled and an enhanced image if the pdf is sent.
         """
 
-        await ctx.trigger_typing()
+        if self._digest is None:
+            await send_error(ctx, 'The substitutions have not been loaded yet.')
+            return
 
-        # Save to a buffer
-        fp = BytesIO()
-        self._image.save(fp, format='PNG')
-        fp.seek(0)
+        await ctx.trigger_typing()
 
         # Create an embed
         out = CommandOutput(
             ctx, title=f'The substitution list for the day **{self._date}**')
         out.embed.set_image(url=f'attachment://{ATTACHMENT_FILENAME}')
 
-        # Send the embed and the attachment
-        await out.send(register=False, file=File(fp, ATTACHMENT_FILENAME))
+        # Send the embed and the memory-mapped attachment
+        with BlobStore.open(self._digest) as fp:
+            await out.send(register=False, file=File(fp, ATTACHMENT_FILENAME))
 
 
 def setup(bot):
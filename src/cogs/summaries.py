@@ -0,0 +1,234 @@
+import asyncio
+import datetime
+import json
+import logging
+import sqlite3
+from traceback import format_exc
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from discord import Embed, Message, RawBulkMessageDeleteEvent, RawMessageDeleteEvent, \
+    RawMessageUpdateEvent, TextChannel
+from discord.ext.commands import Cog
+
+from channel_index import ChannelIndex, IndexEntry
+from client import Marvin
+from database import get_database
+from remote_config import RemoteConfig
+from startup import REMOTE_CONFIG
+
+logger = logging.getLogger('Summaries')
+
+# The number of the latest messages with embeds covered by the index, which holds an entry for each of them
+INDEX_LIMIT = 100
+
+
+def _to_row(channel_id: int, entry: IndexEntry) -> tuple:
+    return (entry.message_id, channel_id, entry.title, entry.description, entry.date and entry.date.isoformat(),
+            json.dumps(entry.field_names))
+
+
+def _from_row(row: sqlite3.Row) -> IndexEntry:
+    date = row['date'] and datetime.datetime.fromisoformat(row['date'])
+    return IndexEntry(row['message_id'], row['title'], row['description'], date, tuple(json.loads(row['field_names'])))
+
+
+def _build_entries(messages: Iterable[Message]) -> List[IndexEntry]:
+    """ Build the entries of the messages with embeds. Blocking, the dates are parsed. """
+    return [IndexEntry.from_embed(msg.id, msg.embeds[0]) for msg in messages if msg.embeds]
+
+
+class Summaries(Cog):
+    """
+    Keeps an index of the exam and homework channels, so their summaries are read from the memory instead of going
+    through the channel history.
+
+    An index holds the entries of the latest INDEX_LIMIT messages with embeds of a channel. It is kept up to date by
+    the message events and persisted in the db. On restart, the persisted index is served right away and checked
+    against the latest messages in the background, which brings in the changes made while the bot was offline.
+    """
+
+    bot: Marvin
+    _indexes: Dict[int, ChannelIndex]  # channel id: its index
+    _loading: Dict[int, asyncio.Task]  # channel id: the task loading its index
+    _refreshing: Dict[int, ChannelIndex]  # channel id: its index being checked against the history
+    _touched: Dict[int, Set[int]]  # channel id: the messages changed by the events while its index is refreshed
+
+    def __init__(self, bot: Marvin):
+        self.bot = bot
+        self.db = get_database()
+        self._indexes = {}
+        self._loading = {}
+        self._refreshing = {}
+        self._touched = {}
+
+        self.bot.startup.add_step('summaries', self._startup, requires=[REMOTE_CONFIG])
+
+    async def _startup(self):
+        channels = [self.bot.get_channel(i) for i in (RemoteConfig.exam_channel_id, RemoteConfig.homework_channel_id)]
+        await asyncio.gather(*[self.get_index(i) for i in channels if i])
+
+    async def get_index(self, channel: TextChannel) -> ChannelIndex:
+        """ Return the index of the channel. On the first call, it is loaded from the db or built from the history. """
+        if (index := self._indexes.get(channel.id)) is not None:
+            return index
+
+        # Join the loading in progress
+        if channel.id not in self._loading:
+            self._loading[channel.id] = asyncio.ensure_future(self._load(channel))
+
+        return await asyncio.shield(self._loading[channel.id])
+
+    async def _load(self, channel: TextChannel) -> ChannelIndex:
+        try:
+            row = await self.db.fetchone('SELECT message_id FROM indexed_channels WHERE channel_id = ?', (channel.id,))
+
+            # A new channel has to be indexed first, a persisted index is checked in the background
+            if row is None:
+                index = ChannelIndex()
+                await self._refresh(channel, index)
+            else:
+                rows = await self.db.execute('SELECT * FROM index_entries WHERE channel_id = ?', (channel.id,))
+                index = ChannelIndex(_from_row(i) for i in rows)
+                asyncio.ensure_future(self._refresh(channel, index))
+
+            self._indexes[channel.id] = index
+            return index
+        finally:
+            del self._loading[channel.id]
+
+    async def _refresh(self, channel: TextChannel, index: ChannelIndex):
+        """ Bring the index in line with the latest INDEX_LIMIT messages with embeds of the channel. """
+        # The events arriving meanwhile are newer than the history, the messages they change are left to them
+        self._refreshing[channel.id] = index
+        touched = self._touched[channel.id] = set()
+
+        # noinspection PyBroadException
+        try:
+            newest, messages = await self._fetch_latest(channel)
+            entries = await asyncio.get_event_loop().run_in_executor(None, _build_entries, messages)
+        except Exception:
+            logger.error(f'Refreshing the index of #{channel} failed!\n{format_exc()}')
+            return
+        finally:
+            del self._refreshing[channel.id]
+            del self._touched[channel.id]
+
+        # Drop the entries of the deleted messages and the ones out of the window, but keep the entries of the
+        # messages posted after the history was fetched
+        found = {entry.message_id for entry in entries}
+        removed = [entry.message_id for entry in list(index) if entry.message_id not in found
+                   and entry.message_id not in touched and (newest is None or entry.message_id <= newest)]
+        changed = [entry for entry in entries
+                   if entry.message_id not in touched and entry != index.get(entry.message_id)]
+
+        for message_id in removed:
+            index.remove(message_id)
+        for entry in changed:
+            index.put(entry)
+
+        # The messages posted meanwhile may have pushed the oldest entries out
+        removed += index.trim(INDEX_LIMIT)
+
+        cursor = max([newest or 0] + [entry.message_id for entry in index])
+        await self._save(channel.id, changed, removed, cursor=cursor)
+        logger.info(f'Indexed #{channel}: {len(index)} entries, {len(changed)} changed, {len(removed)} removed')
+
+    @staticmethod
+    async def _fetch_latest(channel: TextChannel) -> Tuple[Optional[int], List[Message]]:
+        """ Return the id of the newest message and the latest INDEX_LIMIT messages with embeds, newest first. """
+        newest, messages = None, []
+
+        async for msg in channel.history(limit=None):
+            newest = newest or msg.id
+
+            if msg.embeds:
+                messages.append(msg)
+                if len(messages) == INDEX_LIMIT:
+                    break
+
+        return newest, messages
+
+    def _get_live_index(self, channel_id: int) -> Optional[ChannelIndex]:
+        """ Return the index the events of the channel apply to, also while it is being built. """
+        if (index := self._indexes.get(channel_id)) is not None:
+            return index
+
+        return self._refreshing.get(channel_id)
+
+    def _touch(self, channel_id: int, message_ids: Iterable[int]):
+        """ Keep the refresh in progress from overwriting the changes made by the events. """
+        if (touched := self._touched.get(channel_id)) is not None:
+            touched.update(message_ids)
+
+    async def _save(self, channel_id: int, entries: Iterable[IndexEntry] = (), removed: Iterable[int] = (),
+                    cursor: int = None):
+        """ Persist the changes of the index.
+
+        :param channel_id: The id of the channel.
+        :param entries: The new or changed entries.
+        :param removed: The ids of the messages whose entries have been removed.
+        :param cursor: The id of the newest message indexed. None if it has not changed.
+        """
+
+        def job(conn: sqlite3.Connection):
+            conn.executemany('INSERT OR REPLACE INTO index_entries VALUES (?, ?, ?, ?, ?, ?)',
+                             [_to_row(channel_id, i) for i in entries])
+            conn.executemany('DELETE FROM index_entries WHERE message_id = ?', [(i,) for i in removed])
+
+            if cursor is not None:
+                conn.execute('INSERT OR REPLACE INTO indexed_channels VALUES (?, ?)', (channel_id, cursor))
+
+        await self.db.run(job, f'Save the index of {channel_id}')
+
+    @Cog.listener()
+    async def on_message(self, msg: Message):
+        if (index := self._get_live_index(msg.channel.id)) is None:
+            return
+
+        self._touch(msg.channel.id, [msg.id])
+        entries = _build_entries([msg])
+        for entry in entries:
+            index.put(entry)
+
+        # Only the latest messages are covered
+        await self._save(msg.channel.id, entries, index.trim(INDEX_LIMIT), cursor=msg.id)
+
+    @Cog.listener()
+    async def on_raw_message_edit(self, payload: RawMessageUpdateEvent):
+        # Only the edits changing the embeds are of interest
+        if (index := self._get_live_index(payload.channel_id)) is None or 'embeds' not in payload.data:
+            return
+
+        self._touch(payload.channel_id, [payload.message_id])
+
+        if embeds := payload.data['embeds']:
+            entry = IndexEntry.from_embed(payload.message_id, Embed.from_dict(embeds[0]))
+
+            if entry != index.get(payload.message_id):
+                index.put(entry)
+                await self._save(payload.channel_id, [entry])
+
+        elif index.remove(payload.message_id):
+            await self._save(payload.channel_id, removed=[payload.message_id])
+
+    @Cog.listener()
+    async def on_raw_message_delete(self, payload: RawMessageDeleteEvent):
+        if (index := self._get_live_index(payload.channel_id)) is None:
+            return
+
+        self._touch(payload.channel_id, [payload.message_id])
+        if index.remove(payload.message_id):
+            await self._save(payload.channel_id, removed=[payload.message_id])
+
+    @Cog.listener()
+    async def on_raw_bulk_message_delete(self, payload: RawBulkMessageDeleteEvent):
+        if (index := self._get_live_index(payload.channel_id)) is None:
+            return
+
+        self._touch(payload.channel_id, payload.message_ids)
+        if removed := [i for i in payload.message_ids if index.remove(i)]:
+            await self._save(payload.channel_id, removed=removed)
+
+
+def setup(bot: Marvin):
+    bot.add_cog(Summaries(bot))
@@ -13,7 +13,9 @@ import utils
 from client import Marvin
 from command_output import CommandOutput
 from decorators import del_invoc
+from logs import log_buffer
 from remote_config import RemoteConfig
+from summary_pages import SummaryPages
 from timeout_message import TimeoutMessage
 from utils.error import send_error
 
@@ -153,8 +155,8 @@ class Commands(Cog, name='General'):
     async def exam(self, ctx):
         """ Output pending exams. """
         channel = ctx.bot.get_channel(RemoteConfig.exam_channel_id)
-        embed = await utils.EmbedUtils.channel_summary(channel)
-        await CommandOutput(ctx, **embed.to_dict()).send()
+        index = await ctx.bot.get_cog('Summaries').get_index(channel)
+        await SummaryPages(ctx, channel, list(index)).send()
 
     # noinspection SpellCheckingInspection
     @command(aliases=['hw', 'ukol', 'ukoly'])
@@ -162,18 +164,30 @@ class Commands(Cog, name='General'):
     async def homework(self, ctx):
         """ Output pending homeworks. """
         channel = ctx.bot.get_channel(RemoteConfig.homework_channel_id)
-        embed = await utils.EmbedUtils.channel_summary(channel)
-        await CommandOutput(ctx, **embed.to_dict()).send()
+        index = await ctx.bot.get_cog('Summaries').get_index(channel)
+        await SummaryPages(ctx, channel, list(index)).send()
 
     @command(hidden=True)
     @del_invoc
-    async def log(self, ctx):
+    async def log(self, ctx, page: Optional[int] = 1, level: str = 'debug', name: str = None):
         """
         Return the current log.
+
+        The first page contains the newest records. Only the records of at least the `level` can be shown and
+        the records can be limited to the logger `name` and its children, e.g. `!log 2 warning RemoteConfig`.
         """
 
-        log = logging.getLogger().handlers[1].stream.getvalue()
-        log = log[-2000:]
+        levelno = logging.getLevelName(level.upper())
+        if not isinstance(levelno, int):
+            await send_error(ctx, f'Unknown log level `{level}`!')
+            return
+
+        lines = log_buffer.page(page, 1900, levelno, name)
+        if not lines:
+            await send_error(ctx, f'There is no log page {page}!')
+            return
+
+        log = '\n'.join(lines)
         log = f'```{log}```'
 
         await CommandOutput(ctx, description=log).send()
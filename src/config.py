@@ -1,4 +1,6 @@
-from typing import Any, List, Tuple, Optional
+from copy import deepcopy
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Set, Tuple, Optional, Union, get_args, get_origin
 
 import logging
 
@@ -6,13 +8,106 @@ import yaml
 
 logger = logging.getLogger('Config')
 
-ANNOTATION_CONVERTING_OVERRIDES = {'List': list, 'Tuple': tuple, 'Dict': dict}
+Converter = Callable[[Any], Any]
 
 
 class EmptyValue:
     pass
 
 
+def _identity(value: Any) -> Any:
+    return value
+
+
+def compile_converter(annotation: Any) -> Converter:
+    """
+    Build a callable converting a raw value to the annotated type.
+
+    Typing generics such as `List[Tuple[str, str]]` are converted recursively. Plain classes, such as `Timetable` or
+    `EncryptedString`, are constructed from the raw value unless the value is an instance already.
+
+    :param annotation: The type annotation.
+    :return: A converter raising an exception if the value cannot be converted.
+    """
+
+    origin, args = get_origin(annotation), get_args(annotation)
+
+    if annotation is Any:
+        return _identity
+
+    if origin is Union:
+        converters = [compile_converter(i) for i in args if i is not type(None)]
+        optional = len(converters) < len(args)
+
+        def convert(value):
+            if value is None and optional:
+                return None
+
+            for converter in converters:
+                # noinspection PyBroadException
+                try:
+                    return converter(value)
+                except Exception:
+                    pass
+
+            raise ValueError(f'{value!r} is not {annotation}')
+
+        return convert
+
+    if origin is list:
+        item = compile_converter(args[0]) if args else _identity
+        return lambda value: [item(i) for i in value]
+
+    if origin is tuple and len(args) == 2 and args[1] is Ellipsis:
+        item = compile_converter(args[0])
+        return lambda value: tuple(item(i) for i in value)
+
+    if origin is tuple:
+        items = [compile_converter(i) for i in args]
+
+        def convert(value):
+            value = tuple(value)
+
+            if items and len(value) != len(items):
+                raise ValueError(f'Expected {len(items)} items, got {len(value)}')
+
+            return tuple(c(i) for c, i in zip(items, value)) if items else value
+
+        return convert
+
+    if origin is dict:
+        key, val = (compile_converter(args[0]), compile_converter(args[1])) if args else (_identity, _identity)
+        return lambda value: {key(k): val(v) for k, v in dict(value).items()}
+
+    if isinstance(annotation, type):
+        return lambda value: value if isinstance(value, annotation) else annotation(value)
+
+    # Type variables and other annotations we cannot enforce
+    return _identity
+
+
+@dataclass
+class ValidationReport:
+    """
+    The outcome of applying raw config data.
+
+    Attributes:
+        converted: The entries converted in this pass along with their converted values.
+        failed: A list of (name, value, exception) tuples containing the conversions that failed.
+        missing: The names of the entries without a default which are not present in the data.
+        unknown: The keys in the data which are not config entries.
+    """
+
+    converted: Dict[str, Any] = field(default_factory=dict)
+    failed: List[Tuple[str, Any, Exception]] = field(default_factory=list)
+    missing: List[str] = field(default_factory=list)
+    unknown: List[str] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return not self.failed and not self.missing
+
+
 class ConfigBase:
     """
     This class allows to access the config values in a discord channel, which's
@@ -24,42 +119,96 @@ class ConfigBase:
         from remote_config import RemoteConfig\n
         name = RemoteConfig.name
 
+    The converters for the annotated entries are compiled once per class, so applying new data does not need to
+    inspect the annotations again.
+
     Attributes:
         failed_conversions: A list of (name, value, exception) tuples containing the conversions that failed.
+        report: The ValidationReport of the last applied data.
     """
 
     failed_conversions: List[Tuple[str, Any, Exception]]  # name, value, exception
+    report: ValidationReport
+    _data: dict  # The raw entries applied last time
 
     def __init__(self, data: dict):
         self.failed_conversions = []
+        self._data = {}
+
+        self.patch(data)
+
+        for name in self.report.missing:
+            logger.warning(f'Entry {name} not present in the data!')
+
+    @classmethod
+    def _get_converters(cls) -> Dict[str, Tuple[Any, Converter]]:
+        """ Return name: (default, converter) pairs compiled from the class annotations on the first call. """
+        try:
+            return cls.__dict__['_converters']
+        except KeyError:
+            pass
+
+        cls._converters = {
+            name: (getattr(cls, name, EmptyValue), compile_converter(annotation))
+            for name, annotation in cls.__annotations__.items()
+        }
+
+        return cls._converters
+
+    def patch(self, data: dict) -> Set[str]:
+        """
+        Apply only the entries whose raw values differ from the ones applied last time. Entries missing in the data
+        are reset to their defaults. The outcome is stored in the `report` attribute.
+
+        :param data: The complete raw data.
+        :return: The names of the entries that have changed.
+        """
 
-        for name, expected_type in self.__annotations__.items():
-            # Get the actual value
-            default = getattr(self, name)
-            value = data.get(name, default)
+        converters = self._get_converters()
+        report = ValidationReport(unknown=[key for key in data if key not in converters])
+        changed = set()
 
-            if default == value:
+        for name, (default, converter) in converters.items():
+            value = data.get(name, EmptyValue)
+
+            if value is EmptyValue and default is EmptyValue:
+                report.missing.append(name)
+
+            if value == self._data.get(name, EmptyValue):
                 continue
 
+            changed.add(name)
+            self.failed_conversions = [i for i in self.failed_conversions if i[0] != name]
+
             if value is EmptyValue:
-                logger.warning(f'Entry {name} not present in the data!')
+                # Fall back to the class default
+                self.__dict__.pop(name, None)
+                self._data.pop(name)
                 continue
 
-            # See if there is an override for the conversion type
-            expected_type = ANNOTATION_CONVERTING_OVERRIDES.get(
-                getattr(expected_type, '_name', None),
-                expected_type)
+            # Keep our own copy, so the values handed out cannot alter the diff
+            self._data[name] = deepcopy(value)
 
-            if not isinstance(value, expected_type):
-                # Try to convert the value to the type specified by the type annotations
-                try:
-                    value = expected_type(value)
-                except Exception as ex:
-                    logger.warning(f'Could not convert entry {name}: {value} to type {expected_type}, {ex}!')
-                    self.failed_conversions.append((name, value, ex))
+            # Values equal to the default do not need any conversion
+            if value == default:
+                self.__dict__.pop(name, None)
+                continue
+
+            try:
+                value = converter(value)
+            except Exception as ex:
+                logger.warning(f'Could not convert entry {name}: {value} to type {self.__annotations__[name]}, {ex}!')
+                self.failed_conversions.append((name, value, ex))
+                report.failed.append((name, value, ex))
+            else:
+                report.converted[name] = value
 
             setattr(self, name, value)
 
+        self.report = report
+
+        return changed
+
 
 class LocalConfig(ConfigBase):
     # Critical values
@@ -69,6 +218,8 @@ class LocalConfig(ConfigBase):
     # Optional values
     loglevel: int = logging.WARNING
     modulelog: bool = False
+    log_json: bool = False
+    date_languages: List[str] = ['en', 'cs']
     remote_config_channel_name: str = 'config'
     command_prefix: str = '!'
     load_dev_config: bool = False
@@ -77,6 +228,23 @@ class LocalConfig(ConfigBase):
     moodle_password: str = ''
 
 
+class LazyConfig:
+    """ A proxy loading the LocalConfig from the config file on the first attribute access. """
+
+    _path: str
+    _config: Optional[LocalConfig]
+
+    def __init__(self, path: str):
+        self._path = path
+        self._config = None
+
+    def __getattr__(self, name: str):
+        if self._config is None:
+            with open(self._path) as f:
+                self._config = LocalConfig(yaml.safe_load(f))
+
+        return getattr(self._config, name)
+
+
 # Config: LocalConfig
-with open('config.yaml') as f:
-    Config = LocalConfig(yaml.safe_load(f))
+Config = LazyConfig('config.yaml')
@@ -0,0 +1,215 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+from queue import SimpleQueue
+from time import perf_counter
+from traceback import format_exc
+from typing import Any, Callable, Iterable, List, Optional
+
+DB_PATH = 'sqlite.db'
+
+# Queries taking longer than this many seconds are logged as warnings
+SLOW_QUERY_SECONDS = 0.05
+
+# The number of prepared statements kept by the connection
+STATEMENT_CACHE_SIZE = 128
+
+logger = logging.getLogger('Database')
+
+# The schema migrations. Each is run once in its own transaction, after which the `user_version` of the db is set to
+# its index + 1. Only append new migrations, never change the applied ones.
+MIGRATIONS = [
+    # 1: The tables as created by the bot before the migrations were introduced
+    '''
+    CREATE TABLE IF NOT EXISTS guild_config(
+        id INTEGER PRIMARY KEY,
+        calendar_id TEXT DEFAULT "primary"
+    );
+    CREATE TABLE IF NOT EXISTS events (message_id INTEGER, event_id TEXT);
+    ''',
+
+    # 2: Key the events by the message id, keeping the newest event of each message
+    '''
+    CREATE TABLE events_new (message_id INTEGER PRIMARY KEY, event_id TEXT NOT NULL);
+    INSERT INTO events_new
+        SELECT message_id, event_id FROM events
+        WHERE message_id IS NOT NULL AND event_id IS NOT NULL
+          AND rowid IN (SELECT MAX(rowid) FROM events GROUP BY message_id);
+    DROP TABLE events;
+    ALTER TABLE events_new RENAME TO events;
+    CREATE INDEX events_event_id ON events (event_id);
+    ''',
+
+    # 3: The channels synced to the calendar, a JSON list of channel ids
+    '''
+    ALTER TABLE guild_config ADD COLUMN calendar_channel_ids TEXT NOT NULL DEFAULT '[]';
+    ''',
+
+    # 4: The hash of the event body last pushed to the calendar
+    '''
+    ALTER TABLE events ADD COLUMN content_hash TEXT;
+    ''',
+
+    # 5: The state of the calendar reconciliation
+    '''
+    ALTER TABLE events ADD COLUMN channel_id INTEGER;
+    CREATE TABLE calendar_sync_tokens (guild_id INTEGER PRIMARY KEY, sync_token TEXT NOT NULL);
+    CREATE TABLE channel_cursors (channel_id INTEGER PRIMARY KEY, message_id INTEGER NOT NULL);
+    ''',
+
+    # 6: The last message processed by the calendar backfill of each channel
+    '''
+    CREATE TABLE backfill_checkpoints (channel_id INTEGER PRIMARY KEY, message_id INTEGER NOT NULL);
+    ''',
+
+    # 7: The index of the exam and homework channels, the message id of a channel is the newest message indexed
+    '''
+    CREATE TABLE index_entries (
+        message_id INTEGER PRIMARY KEY,
+        channel_id INTEGER NOT NULL,
+        title TEXT NOT NULL,
+        description TEXT NOT NULL,
+        date TEXT,
+        field_names TEXT NOT NULL
+    );
+    CREATE INDEX index_entries_channel_id ON index_entries (channel_id);
+    CREATE TABLE indexed_channels (channel_id INTEGER PRIMARY KEY, message_id INTEGER NOT NULL);
+    ''',
+]
+
+Job = Callable[[sqlite3.Connection], Any]
+
+
+def migrate(conn: sqlite3.Connection):
+    """ Apply the migrations the db has not gone through yet. """
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+
+    for version, script in enumerate(MIGRATIONS[version:], version + 1):
+        logger.info(f'Migrating the db to the version {version}')
+
+        try:
+            conn.executescript(f'BEGIN; {script}; PRAGMA user_version = {version}; COMMIT;')
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+
+
+def _resolve(future: asyncio.Future, result: Any = None, exception: BaseException = None):
+    # The waiting coroutine might have been cancelled meanwhile
+    if future.cancelled():
+        return
+
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+
+
+class Database:
+    """
+    The shared access to `sqlite.db`.
+
+    A single connection lives on a dedicated thread, which migrates the db and then runs the queued requests one by
+    one. The coroutines awaiting the results never block the event loop, not even on the disk syncs of a commit. The
+    db is in the WAL mode, so reads do not wait for the writes of other processes.
+    """
+
+    _path: str
+    _queue: SimpleQueue
+    _thread: threading.Thread
+
+    def __init__(self, path: str = DB_PATH):
+        self._path = path
+        self._queue = SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name='Database', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        # The connection may only be used by the thread which created it
+        conn = sqlite3.connect(self._path, cached_statements=STATEMENT_CACHE_SIZE)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+
+        # Requests are served even if the migrations failed, they will fail themselves if they need the new schema
+        # noinspection PyBroadException
+        try:
+            migrate(conn)
+        except Exception:
+            logger.critical(f'Migrating {self._path} failed!\n{format_exc()}')
+
+        while (request := self._queue.get()) is not None:
+            loop, future, job, description = request
+
+            start = perf_counter()
+            try:
+                result = job(conn)
+            except BaseException as ex:
+                loop.call_soon_threadsafe(_resolve, future, None, ex)
+            else:
+                loop.call_soon_threadsafe(_resolve, future, result)
+
+            duration = perf_counter() - start
+            if duration > SLOW_QUERY_SECONDS:
+                logger.warning(f'Slow query ({duration * 1000:.1f} ms): {description}')
+            else:
+                logger.debug(f'Query ({duration * 1000:.1f} ms): {description}')
+
+        conn.close()
+
+    async def run(self, job: Job, description: str = None) -> Any:
+        """ Run the callable with the connection on the db thread and return its result.
+
+        :param job: A callable taking the connection. It runs in a transaction committed once it returns.
+        :param description: The description used in the query log.
+        """
+
+        def transaction(conn: sqlite3.Connection):
+            with conn:
+                return job(conn)
+
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._queue.put((loop, future, transaction, description or getattr(job, '__name__', repr(job))))
+
+        return await future
+
+    async def execute(self, sql: str, params: Iterable = ()) -> List[sqlite3.Row]:
+        """ Execute the statement and return all the rows. """
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall(), sql)
+
+    async def fetchone(self, sql: str, params: Iterable = ()) -> Optional[sqlite3.Row]:
+        """ Execute the statement and return the first row. None if there is none. """
+        return await self.run(lambda conn: conn.execute(sql, params).fetchone(), sql)
+
+    async def executemany(self, sql: str, params: Iterable[Iterable]):
+        """ Execute the statement for each of the parameter sequences in a single transaction. """
+        await self.run(lambda conn: conn.executemany(sql, params), sql)
+
+    def close(self):
+        """ Finish the queued requests and close the connection. Blocks until done. """
+        self._queue.put(None)
+        self._thread.join()
+
+
+_database: Optional[Database] = None
+
+
+def get_database() -> Database:
+    """ Return the shared Database. It is started on the first call. """
+    global _database
+
+    if _database is None:
+        _database = Database()
+
+    return _database
+
+
+async def close_database():
+    """ Close the shared Database if it has been started. """
+    global _database
+
+    if _database is not None:
+        await asyncio.get_event_loop().run_in_executor(None, _database.close)
+        _database = None
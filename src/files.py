@@ -0,0 +1,22 @@
+import os
+from tempfile import mkstemp
+
+
+def write_atomic(path: str, data: bytes):
+    """
+    Write to a temporary file next to the target and swap it in, so a crash cannot leave a half-written file.
+    The temporary file is removed if the write fails.
+
+    :param path: The path of the file to be replaced. Its folder has to exist.
+    :param data: The new content of the file.
+    """
+
+    directory, name = os.path.split(path)
+    fd, tmp_path = mkstemp(dir=directory or '.', prefix=f'.{name}.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
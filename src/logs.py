@@ -0,0 +1,165 @@
+import atexit
+import json
+import logging
+import sys
+from collections import deque
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from typing import Deque, List, NamedTuple, Optional
+
+from config import Config
+
+LOG_FORMAT = '[%(levelname)-8s] [%(name)-16s] %(message)s'
+
+# The number of records kept for the !log command
+LOG_BUFFER_SIZE = 2000
+
+# Loggers of external modules, which are disabled unless `modulelog` is set in the config
+MODULE_LOGGERS = [
+    'discord.gateway',
+    'discord.client',
+    'discord.http',
+    'websockets.protocol',
+]
+
+
+class LogEntry(NamedTuple):
+    created: float
+    levelno: int
+    name: str
+    text: str  # The formatted record
+
+
+class RingBufferHandler(logging.Handler):
+    """
+    Keeps the last `capacity` records in memory. The oldest records are dropped when the buffer is full, so both
+    the memory and the cost of a record stay constant.
+    """
+
+    _entries: Deque[LogEntry]
+
+    def __init__(self, capacity: int = LOG_BUFFER_SIZE):
+        super().__init__()
+        self._entries = deque(maxlen=capacity)
+
+    def emit(self, record: logging.LogRecord):
+        # noinspection PyBroadException
+        try:
+            self._entries.append(LogEntry(record.created, record.levelno, record.name, self.format(record)))
+        except Exception:
+            self.handleError(record)
+
+    def page(self, page: int = 1, max_chars: int = 2000, level: int = logging.NOTSET,
+             name: Optional[str] = None) -> List[str]:
+        """
+        Return a page of the formatted records, walking back from the newest one.
+
+        :param page: The page number, the first page contains the newest records.
+        :param max_chars: The maximum length of a page including the newlines.
+        :param level: The minimal level of the records.
+        :param name: Only return the records of this logger and its children.
+        :return: The lines of the page, oldest first. Empty if there are not as many pages.
+        """
+
+        name = name and name.lower()
+        lines, length = [], 0
+
+        # Hold the lock, the deque cannot be iterated while a record is appended
+        with self.lock:
+            for entry in reversed(self._entries):
+                if entry.levelno < level:
+                    continue
+                if name and not (entry.name.lower() == name or entry.name.lower().startswith(name + '.')):
+                    continue
+
+                # A single record always fits on a page along with its newline
+                text = entry.text[:max_chars - 1]
+
+                # Start a new page
+                if length + len(text) + 1 > max_chars:
+                    if page == 1:
+                        break
+                    page -= 1
+                    lines, length = [], 0
+
+                lines.append(text)
+                length += len(text) + 1
+
+        return lines[::-1] if page == 1 else []
+
+
+class JsonFormatter(logging.Formatter):
+    """ Formats the records as compact JSON lines. """
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'time': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+
+# The !log handler
+log_buffer = RingBufferHandler()
+
+_listener: Optional[QueueListener] = None
+
+
+def setup_logging():
+    """
+    Configure the root logger. Should be called once at the startup.
+
+    The root logger only puts the records into a queue. Formatting them and writing them to stdout and the !log
+    buffer is done by a listener thread, so logging never blocks the event loop.
+    """
+
+    global _listener
+
+    # Handlers of the listener thread
+    stdout_handler = logging.StreamHandler(sys.stdout)
+    stdout_handler.setFormatter(JsonFormatter() if Config.log_json else logging.Formatter(LOG_FORMAT))
+    log_buffer.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    queue = SimpleQueue()
+    _listener = QueueListener(queue, stdout_handler, log_buffer)
+    _listener.start()
+    atexit.register(stop_logging)
+
+    # The message is merged with the traceback before the record is queued
+    queue_handler = QueueHandler(queue)
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))
+    logging.basicConfig(level=Config.loglevel, handlers=[queue_handler])
+    if not Config.modulelog:
+        for name in MODULE_LOGGERS:
+            logging.getLogger(name).disabled = True
+
+
+def stop_logging():
+    """ Write out the queued records and stop the listener thread. """
+    global _listener
+
+    if _listener:
+        _listener.stop()
+        _listener = None
+
+
+if __name__ == '__main__':
+    _handler = RingBufferHandler(capacity=10)
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    _logger = logging.getLogger('logs_test')
+    _logger.addHandler(_handler)
+
+    _logger.warning('short')
+    _logger.warning('x' * 50)
+
+    # A record longer than the page is truncated, so it still makes up a page of its own
+    assert _handler.page(1, max_chars=20) == ['x' * 19]
+    assert _handler.page(2, max_chars=20) == ['short']
+    assert _handler.page(3, max_chars=20) == []
+    assert len('\n'.join(_handler.page(1, max_chars=20))) <= 20
@@ -4,9 +4,12 @@ from client import Marvin
 from config import Config
 from help import CustomHelpCommand
 from exceptions import MarvinInitializeException
+from logs import setup_logging
 
 
 def main():
+    setup_logging()
+
     try:
         client = Marvin(command_prefix=Config.command_prefix, help_command=CustomHelpCommand())
     except MarvinInitializeException:
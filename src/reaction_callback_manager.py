@@ -91,7 +91,10 @@ class ReactionCallbackManager:
     async def cleanup(self):
         """ Remove all the reactions and the listener. """
         # Clear reactions
-        await self.msg.clear_reactions()
+        try:
+            await self.msg.clear_reactions()
+        except NotFound:
+            logger.warning('Tried clearing reactions on non-existing message!')
 
         # Remove listener
         self.ctx.bot.remove_listener(self.on_raw_reaction_add)
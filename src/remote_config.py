@@ -1,19 +1,175 @@
+import asyncio
+import json
 import logging
-from typing import Dict, List, Tuple
+from dataclasses import asdict, dataclass
+from traceback import format_exc
+from typing import Dict, List, Optional, Set, Tuple
 
 import yaml
-from discord import TextChannel, utils
+from discord import Message, NotFound, Object, RawBulkMessageDeleteEvent, RawMessageDeleteEvent, \
+    RawMessageUpdateEvent, TextChannel, utils
 from discord.ext.commands import Cog, Context, group
 
 from config import Config, ConfigBase
+from data import DATA_DIR
 from decorators import del_invoc, list_subcommands
-from secure_config import EncryptedString
+from files import write_atomic
+from secure_config import EncryptedString, ensure_key
+from startup import REMOTE_CONFIG
 from timeout_message import TimeoutMessage
 from timetable import Timetable
 
+SNAPSHOT_PATH = DATA_DIR + 'remote_config.json'
+
+# Dispatched with the set of changed entry names. Cogs subscribe by listening to `on_remote_config_change`.
+CONFIG_CHANGE_EVENT = 'remote_config_change'
+
 logger = logging.getLogger('RemoteConfig')
 
 
+def _parse_message(msg: Message) -> Tuple[bool, Optional[dict]]:
+    """
+    Parse a single config message.
+
+    :param msg: The message from the config channel.
+    :return: A (is_dev, fragment) tuple. The fragment is None if the message could not be parsed into a dict.
+    """
+
+    content = msg.clean_content
+    is_dev = content.startswith('dev')
+
+    # Clean up
+    content = content.replace('```yaml', '').replace('```', '').replace('dev', '', 1)
+
+    # Convert
+    # noinspection PyBroadException
+    try:
+        fragment = yaml.safe_load(content)
+    except Exception:
+        logger.warning(f'Converting message {msg.id} to yaml failed!')
+        return is_dev, None
+
+    if not isinstance(fragment, dict):
+        logger.warning(f'Converting message {msg.id} to dict failed!')
+        return is_dev, None
+
+    return is_dev, fragment
+
+
+@dataclass
+class SnapshotEntry:
+    edited_at: Optional[float]  # The edit timestamp the fragment was parsed at
+    is_dev: bool
+    fragment: Optional[dict]
+
+
+class ConfigSnapshot:
+    """
+    A local copy of the parsed config messages keyed by the message id.
+
+    The snapshot is persisted to the disk, so the config can be rebuilt on a warm boot without touching the network.
+    Only the messages which are new or were edited since they were parsed will be parsed again.
+
+    Attributes:
+        entries: A dict of message id: SnapshotEntry pairs.
+    """
+
+    entries: Dict[int, SnapshotEntry]
+
+    def __init__(self):
+        self.entries = {}
+
+    @property
+    def newest_id(self) -> Optional[int]:
+        """ The id of the newest message in the snapshot. None if the snapshot is empty. """
+        return max(self.entries, default=None)
+
+    def load(self) -> bool:
+        """ Load the snapshot from the disk. Return whether successful. """
+        try:
+            with open(SNAPSHOT_PATH) as f:
+                data: dict = json.load(f)
+        except (OSError, ValueError):
+            logger.info(f'{SNAPSHOT_PATH} could not be loaded. The config will be loaded from the channel.')
+            return False
+
+        self.entries = {int(id_): SnapshotEntry(**entry) for id_, entry in data.items()}
+        logger.debug(f'Loaded {len(self.entries)} config messages from the snapshot.')
+
+        return True
+
+    def save(self):
+        """ Save the snapshot to the disk. The file is replaced atomically. """
+        data = {str(id_): asdict(entry) for id_, entry in self.entries.items()}
+
+        write_atomic(SNAPSHOT_PATH, json.dumps(data).encode())
+
+    def update(self, msg: Message) -> bool:
+        """ Parse the message if it is new or was edited since. Return whether the snapshot has changed. """
+        edited_at = msg.edited_at.timestamp() if msg.edited_at else None
+
+        entry = self.entries.get(msg.id)
+        if entry and entry.edited_at == edited_at:
+            return False
+
+        is_dev, fragment = _parse_message(msg)
+        self.entries[msg.id] = SnapshotEntry(edited_at, is_dev, fragment)
+
+        return True
+
+    def remove(self, message_id: int) -> bool:
+        """ Remove the message from the snapshot. Return whether it was present. """
+        return self.entries.pop(message_id, None) is not None
+
+    async def sync(self, ch: TextChannel, verify: bool = True) -> bool:
+        """
+        Bring the snapshot up to date with the channel.
+
+        :param ch: The config channel.
+        :param verify: Whether to go through the whole channel in order to pick up edited and deleted messages.
+            Otherwise only the messages newer than the newest message in the snapshot are fetched.
+        :return: Whether the snapshot has changed.
+        """
+
+        changed = False
+
+        if not verify and self.entries:
+            async for msg in ch.history(limit=None, after=Object(self.newest_id), oldest_first=True):
+                changed |= self.update(msg)
+
+            return changed
+
+        present = set()
+        async for msg in ch.history(limit=None, oldest_first=True):
+            present.add(msg.id)
+            changed |= self.update(msg)
+
+        # Drop deleted messages
+        for id_ in set(self.entries) - present:
+            changed |= self.remove(id_)
+
+        return changed
+
+    def to_data(self, load_dev: bool = False) -> dict:
+        """
+        Return a dict built from the fragments in the order of the messages.
+
+        :param load_dev: Whether dev config should be loaded. These are messages starting with `dev`.
+        """
+
+        data = {}
+        for id_ in sorted(self.entries):
+            entry = self.entries[id_]
+
+            if entry.is_dev and not load_dev:
+                continue
+
+            if entry.fragment:
+                data.update(entry.fragment)
+
+        return data
+
+
 async def config_from_channel(ch: TextChannel, load_dev: bool = False) -> dict:
     """ Return a dict built from yaml-formatted messages in the channel.
     :param ch: The text channel the config should be taken from.
@@ -22,32 +178,9 @@ async def config_from_channel(ch: TextChannel, load_dev: bool = False) -> dict:
     :return:
     """
 
-    data = {}
-    async for msg in ch.history(oldest_first=True):
-        content = msg.clean_content
-
-        _is_dev = content.startswith('dev')
-        if _is_dev and not load_dev:
-            continue
-        elif _is_dev:
-            logger.debug('Loaded message ' + msg.content.replace('\n', '\\n'))
-
-        # Clean up
-        content = content.replace('```yaml', '').replace('```', '').replace('dev', '', 1)
-
-        # Convert
-        # noinspection PyBroadException
-        try:
-            partial_data = yaml.safe_load(content)
-        except Exception:
-            logger.warning(f'Converting message {msg.id} to yaml failed!')
-            continue
-
-        # Update the real data
-        try:
-            data.update(partial_data)
-        except ValueError:
-            logger.warning(f'Converting message {msg.id} to dict failed!')
+    snapshot = ConfigSnapshot()
+    await snapshot.sync(ch)
+    data = snapshot.to_data(load_dev)
 
     # Warn if content could not be loaded
     if not data:
@@ -71,29 +204,144 @@ class RemoteConfig_(ConfigBase):
     chatbot_memory_seconds: int = 120
 
 
+# The entries which need the decryption key in order to be converted
+ENCRYPTED_ENTRIES = [name for name, type_ in RemoteConfig_.__annotations__.items() if type_ is EncryptedString]
+
 # TEMPORARY
 RemoteConfig = RemoteConfig_({})
 
 
 class RemoteConfigCog(Cog):
     config = RemoteConfig
+    snapshot: ConfigSnapshot
+    _channel: Optional[TextChannel] = None
+    _verifying: Optional[asyncio.Task] = None  # The background check of the snapshot against the channel
 
     def __init__(self, bot):
         self.bot = bot
+        self.snapshot = ConfigSnapshot()
 
-    @Cog.listener()
-    async def on_connect(self):
-        logger.info(f'Reloading the config from channel `{Config.remote_config_channel_name}`')
+        # Warm boot from the local snapshot
+        if self.snapshot.load():
+            RemoteConfig.patch(self.snapshot.to_data(Config.load_dev_config))
+
+        self.bot.startup.add_step(REMOTE_CONFIG, self._startup)
 
-        # Get the config channel
+    async def _get_channel(self) -> TextChannel:
         await self.bot.fetch_guild(Config.guild_id)
         guild = self.bot.get_guild(Config.guild_id)
-        channel = await self.bot.fetch_channel(utils.get(guild.channels, name=Config.remote_config_channel_name).id)
+        return await self.bot.fetch_channel(utils.get(guild.channels, name=Config.remote_config_channel_name).id)
+
+    def _is_config_channel(self, channel_id: int) -> bool:
+        return self._channel is not None and channel_id == self._channel.id
+
+    async def _apply(self) -> Set[str]:
+        """
+        Save the snapshot, patch the changed entries in RemoteConfig and notify the listeners.
+
+        :return: The names of the changed entries.
+        """
+
+        self.snapshot.save()
+
+        data = self.snapshot.to_data(Config.load_dev_config)
+        if not data:
+            logger.warning(f'No config content found in the channel {self._channel}')
+
+        # Derive the key off the event loop before any decryption is needed
+        if any(name in data for name in ENCRYPTED_ENTRIES):
+            await ensure_key()
+
+        changed = RemoteConfig.patch(data)
+
+        if changed:
+            logger.info(f'Config entries changed: {", ".join(sorted(changed))}')
+            self.bot.dispatch(CONFIG_CHANGE_EVENT, changed)
+
+        return changed
+
+    async def load(self, verify: bool):
+        """
+        Sync the snapshot with the config channel and apply the changes.
+
+        :param verify: See ConfigSnapshot.sync.
+        """
+
+        self._channel = await self._get_channel()
+
+        if not await self.snapshot.sync(self._channel, verify):
+            logger.debug('The config snapshot is up to date.')
+            return
+
+        await self._apply()
+
+    async def _startup(self):
+        # Without a snapshot there is nothing to serve, the config has to be loaded from the channel first
+        if not self.snapshot.entries:
+            logger.info(f'Loading the config from channel `{Config.remote_config_channel_name}`')
+            await self.load(verify=True)
+            return
 
-        # Load the config
-        data = await config_from_channel(channel, load_dev=Config.load_dev_config)
+        # The snapshot is already applied, it is checked for the changes made while offline in the background
+        self._channel = await self._get_channel()
+        self._verify_later()
 
-        RemoteConfig.__init__(data)
+    def _verify_later(self):
+        """ Sync the snapshot with the whole channel in the background, unless already in progress. """
+        if self._verifying is None or self._verifying.done():
+            self._verifying = asyncio.ensure_future(self._verify())
+
+    async def _verify(self):
+        logger.info(f'Verifying the config snapshot against channel `{Config.remote_config_channel_name}`')
+
+        # noinspection PyBroadException
+        try:
+            await self.load(verify=True)
+        except Exception:
+            logger.error(f'Verifying the config snapshot failed!\n{format_exc()}')
+
+    @Cog.listener()
+    async def on_connect(self):
+        # The first load is a startup step, we only need to catch up after reconnecting
+        if self.bot.startup.done:
+            self._verify_later()
+
+    @Cog.listener()
+    async def on_message(self, msg: Message):
+        if not self._is_config_channel(msg.channel.id):
+            return
+
+        if self.snapshot.update(msg):
+            await self._apply()
+
+    @Cog.listener()
+    async def on_raw_message_edit(self, payload: RawMessageUpdateEvent):
+        if not self._is_config_channel(payload.channel_id):
+            return
+
+        try:
+            msg = await self._channel.fetch_message(payload.message_id)
+        except NotFound:
+            return
+
+        if self.snapshot.update(msg):
+            await self._apply()
+
+    @Cog.listener()
+    async def on_raw_message_delete(self, payload: RawMessageDeleteEvent):
+        if not self._is_config_channel(payload.channel_id):
+            return
+
+        if self.snapshot.remove(payload.message_id):
+            await self._apply()
+
+    @Cog.listener()
+    async def on_raw_bulk_message_delete(self, payload: RawBulkMessageDeleteEvent):
+        if not self._is_config_channel(payload.channel_id):
+            return
+
+        if any([self.snapshot.remove(id_) for id_ in payload.message_ids]):
+            await self._apply()
 
     @group(hidden=True)
     @list_subcommands
@@ -105,8 +353,14 @@ class RemoteConfigCog(Cog):
     @del_invoc
     async def reload(self, ctx: Context):
         """ Reload the remote config. """
-        await self.on_connect()
-        await TimeoutMessage(ctx).send('✅ The config has been reloaded!')
+        logger.info(f'Reloading the config from channel `{Config.remote_config_channel_name}`')
+        await self.load(verify=True)
+
+        message = '✅ The config has been reloaded!'
+        if RemoteConfig.failed_conversions:
+            message += '\n⚠ Invalid entries: ' + ', '.join(f'`{i[0]}`' for i in RemoteConfig.failed_conversions)
+
+        await TimeoutMessage(ctx).send(message)
 
 
 def setup(bot):
@@ -1,4 +1,8 @@
+import asyncio
 import base64
+import threading
+from functools import lru_cache
+from typing import Optional
 
 from cryptography.fernet import Fernet
 from cryptography.hazmat.backends import default_backend
@@ -9,26 +13,47 @@ from discord.ext.commands import Cog, Context, command
 from config import Config
 from timeout_message import TimeoutMessage
 
-password = Config.token.encode()
-kdf = PBKDF2HMAC(
-    algorithm=hashes.SHA256(),
-    length=32,
-    salt=b'Marvin',
-    iterations=100000,
-    backend=default_backend()
-)
-key = base64.urlsafe_b64encode(kdf.derive(password))
-fernet = Fernet(key)
+# The number of decrypted values to remember
+DECRYPT_CACHE_SIZE = 128
+
+_fernet: Optional[Fernet] = None
+_fernet_lock = threading.Lock()
+
+
+def _get_fernet() -> Fernet:
+    """ Return the Fernet instance. The key is derived from the API token on the first call. """
+    global _fernet
+
+    with _fernet_lock:
+        if _fernet is None:
+            kdf = PBKDF2HMAC(
+                algorithm=hashes.SHA256(),
+                length=32,
+                salt=b'Marvin',
+                iterations=100000,
+                backend=default_backend()
+            )
+            key = base64.urlsafe_b64encode(kdf.derive(Config.token.encode()))
+            _fernet = Fernet(key)
+
+    return _fernet
+
+
+async def ensure_key():
+    """ Derive the key in an executor, so the key derivation does not block the event loop. """
+    if _fernet is None:
+        await asyncio.get_running_loop().run_in_executor(None, _get_fernet)
 
 
 def encrypt(string: str) -> str:
     """ Return string encrypted by the API key. """
-    return fernet.encrypt(string.encode()).decode()
+    return _get_fernet().encrypt(string.encode()).decode()
 
 
+@lru_cache(maxsize=DECRYPT_CACHE_SIZE)
 def decrypt(string: str) -> str:
-    """ Return string decrypted by yhe API key. """
-    return fernet.decrypt(string.encode()).decode()
+    """ Return string decrypted by yhe API key. The results are memoized by the ciphertext. """
+    return _get_fernet().decrypt(string.encode()).decode()
 
 
 class EncryptedString(str):
@@ -48,6 +73,7 @@ class SecurityCog(Cog):
         if ctx.guild:
             await ctx.message.delete()
 
+        await ensure_key()
         encrypted = encrypt(string)
 
         await TimeoutMessage(ctx, 10).send(
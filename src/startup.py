@@ -0,0 +1,164 @@
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from time import perf_counter
+from traceback import format_exc
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+
+logger = logging.getLogger('Startup')
+
+StepCallback = Callable[[], Awaitable[None]]
+
+# The step loading the remote config. Steps reading RemoteConfig should depend on it.
+REMOTE_CONFIG = 'remote_config'
+
+
+@dataclass
+class StartupStep:
+    """
+    An initialization step of a cog.
+
+    Attributes:
+        name: The unique name other steps can depend on.
+        callback: The coroutine function doing the work.
+        requires: The names of the steps which have to finish first.
+        duration: How long the callback took in seconds.
+        ready_after: The seconds between the start of the startup and the end of this step.
+        failed: Whether the step or any of its dependencies raised an exception.
+    """
+
+    name: str
+    callback: StepCallback
+    requires: List[str] = field(default_factory=list)
+    duration: Optional[float] = None
+    ready_after: Optional[float] = None
+    failed: bool = False
+
+
+class StartupOrchestrator:
+    """
+    Runs the initialization steps of the cogs once the bot is ready.
+
+    Cogs declare their steps along with the steps they depend on, usually in their `__init__`. Steps whose
+    dependencies have finished run concurrently. `wait_ready` acts as a barrier which is passed once all the steps
+    have finished.
+    """
+
+    _steps: Dict[str, StartupStep]
+    _ready: asyncio.Event
+    _start: Optional[float] = None
+
+    def __init__(self):
+        self._steps = {}
+        self._ready = asyncio.Event()
+
+    @property
+    def started(self) -> bool:
+        return self._start is not None
+
+    @property
+    def done(self) -> bool:
+        return self._ready.is_set()
+
+    def add_step(self, name: str, callback: StepCallback, requires: Iterable[str] = ()):
+        """
+        Declare a step. A step added after the startup has begun runs right away.
+
+        :param name: The unique name of the step.
+        :param callback: A coroutine function without arguments.
+        :param requires: The names of the steps which need to finish before this one.
+        """
+
+        if name in self._steps:
+            raise ValueError(f'Startup step {name} is already declared!')
+
+        step = StartupStep(name, callback, list(requires))
+        self._steps[name] = step
+
+        if self.started:
+            asyncio.ensure_future(self._run_late_step(step))
+
+    def _check_dependencies(self):
+        """ Raise ValueError if a dependency is not declared or the dependencies are cyclic. """
+        visiting, visited = set(), set()
+
+        def visit(name: str):
+            if name in visited:
+                return
+            if name in visiting:
+                raise ValueError(f'Startup step {name} depends on itself!')
+
+            visiting.add(name)
+            for dependency in self._steps[name].requires:
+                if dependency not in self._steps:
+                    raise ValueError(f'Startup step {name} requires an undeclared step {dependency}!')
+                visit(dependency)
+            visiting.remove(name)
+            visited.add(name)
+
+        for name_ in self._steps:
+            visit(name_)
+
+    async def _run_step(self, step: StartupStep, tasks: Dict[str, asyncio.Task]):
+        # Wait for the dependencies
+        for dependency in step.requires:
+            if dependency in tasks:
+                await tasks[dependency]
+
+            if self._steps[dependency].failed:
+                logger.error(f'Skipping the startup step {step.name}, because {dependency} failed.')
+                step.failed = True
+                return
+
+        start = perf_counter()
+        try:
+            await step.callback()
+        except Exception:
+            logger.error(f'Startup step {step.name} failed!\n{format_exc()}')
+            step.failed = True
+
+        step.duration = perf_counter() - start
+        step.ready_after = perf_counter() - self._start
+
+    async def _run_late_step(self, step: StartupStep):
+        # The dependencies are all done once the startup has finished
+        await self.wait_ready()
+        await self._run_step(step, {})
+        logger.info(f'Late startup step {step.name} took {step.duration * 1000:.1f} ms')
+
+    async def run(self):
+        """ Run all the declared steps and report the timings. Only the first call has an effect. """
+        if self.started:
+            return
+
+        self._check_dependencies()
+
+        self._start = perf_counter()
+
+        # The tasks will not start before the dict is complete
+        tasks = {}
+        for step in self._steps.values():
+            tasks[step.name] = asyncio.ensure_future(self._run_step(step, tasks))
+
+        await asyncio.gather(*tasks.values())
+
+        self._ready.set()
+        self.report()
+
+    async def wait_ready(self):
+        """ Wait until all the steps have finished. """
+        await self._ready.wait()
+
+    def report(self):
+        """ Log the duration of each step and the time it took until the step was ready. """
+        lines = [f'{"Step":<24}{"Duration":>12}{"Ready after":>14}']
+
+        for step in sorted(self._steps.values(), key=lambda x: x.ready_after or 0):
+            if step.duration is None:
+                lines.append(f'{step.name:<24}{"skipped":>12}')
+                continue
+
+            lines.append(f'{step.name:<24}{step.duration * 1000:>9.1f} ms{step.ready_after * 1000:>11.1f} ms'
+                         + ' (failed)' * step.failed)
+
+        logger.info('Startup finished:\n' + '\n'.join(lines))
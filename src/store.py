@@ -1,20 +1,52 @@
+import asyncio
 import json
 import logging
+import threading
+from typing import List, Optional, Tuple
 
 from data import DATA_DIR
+from files import write_atomic
 
 
 STORE_PATH = DATA_DIR + 'store.json'
 
+# Changes made within this many seconds are written together
+SAVE_DELAY = 2
+
 logger = logging.getLogger('Store')
 
 
 class Store:
+    """
+    Data set by the bot commands, persisted in `data/store.json`.
+
+    Setting a stored attribute marks the store dirty. `save` then schedules a single write after `SAVE_DELAY`
+    seconds, so a burst of changes results in one write done in an executor. `flush` writes the pending changes
+    right away and should be called on shutdown. Writes never overlap and an older snapshot of the data never
+    replaces a newer one.
+    """
+
     command_panel_channel_id: int
     table_url: str
     counting_channel_id: int
     ok_channel_id: int
 
+    _dirty: bool = False
+    _flush_task: Optional[asyncio.Task] = None
+    _write_lock = threading.Lock()  # Held while writing, either by the event loop or by an executor
+    _version: int = 0  # The number of the snapshots taken by _take_data
+    _written_version: int = 0  # The snapshot on the disk
+
+    @classmethod
+    def _stored_attrs(cls) -> List[str]:
+        return [attr for attr in cls.__annotations__ if not attr.startswith('_')]
+
+    def __setattr__(self, key, value):
+        if not key.startswith('_') and getattr(self, key, None) != value:
+            self._dirty = True
+
+        super().__setattr__(key, value)
+
     def load(self) -> bool:
         """ Load stored data. Return whether successful. """
         # Load json
@@ -32,19 +64,56 @@ class Store:
         for key, value in data.items():
             setattr(self, key, value)
 
-        for attr, _ in self.__annotations__.items():
+        for attr in self._stored_attrs():
             setattr(self, attr, data.get(attr, None))
 
+        self._dirty = False
+
         return True
 
+    def _take_data(self) -> Tuple[int, dict]:
+        """ Return the version and the data to be written and mark the store clean. """
+        self._dirty = False
+        self._version += 1
+
+        return self._version, {attr: getattr(self, attr, None) for attr in self._stored_attrs()}
+
+    def _write(self, version: int, data: dict):
+        # Waits for a write in progress. A crash cannot leave a truncated file.
+        with self._write_lock:
+            # A newer snapshot has been written in the meantime, e.g. by flush
+            if version < self._written_version:
+                return
+
+            write_atomic(STORE_PATH, json.dumps(data).encode())
+            self._written_version = version
+
+        logger.debug(f'Saved {STORE_PATH}')
+
+    async def _flush_later(self):
+        await asyncio.sleep(SAVE_DELAY)
+        self._flush_task = None
+
+        if self._dirty:
+            await asyncio.get_event_loop().run_in_executor(None, self._write, *self._take_data())
+
     def save(self):
-        # Get data from attributes
-        data = {}
+        """ Schedule writing the changes. Writes right away if there is no running event loop. """
+        if not self._dirty or self._flush_task:
+            return
+
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()
+        else:
+            self._flush_task = asyncio.ensure_future(self._flush_later())
 
-        for attr, _ in self.__annotations__.items():
-            value = getattr(self, attr, None)
-            data[attr] = value
+    def flush(self):
+        """ Write the pending changes right away. """
+        if self._flush_task:
+            self._flush_task.cancel()
+            self._flush_task = None
 
-        # Save json
-        with open(STORE_PATH, 'w') as f:
-            json.dump(data, f, indent=4)
+        if self._dirty:
+            self._write(*self._take_data())
@@ -0,0 +1,121 @@
+import asyncio
+from typing import Iterable, Iterator, List, Optional
+
+from discord import Embed, TextChannel
+from discord.ext.commands import Context
+
+from channel_index import IndexEntry
+from command_output import CommandOutput
+from reaction_callback_manager import ReactionCallbackManager
+from utils import EmbedUtils
+
+# The limits of a page, well below the 25 fields and 6000 characters discord accepts in an embed
+PAGE_FIELDS = 10
+PAGE_CHARS = 4000
+
+# The seconds the pages can be navigated for
+PAGES_TIMEOUT = 300
+
+
+class SummaryPages:
+    """
+    A channel summary split into pages of at most PAGE_FIELDS entries and PAGE_CHARS characters.
+
+    Only the first page is built and sent right away. The user navigates the pages with the reactions, a page is
+    built once it is first shown.
+    """
+
+    ctx: Context
+    channel: TextChannel
+
+    _entries: Iterator[IndexEntry]  # The entries not paged yet
+    _next_entry: Optional[IndexEntry]  # The first entry of the next page, None if all the entries are paged
+    _pages: List[List[IndexEntry]]  # The pages built so far
+    _page: int = 0  # The index of the page shown
+    _output: CommandOutput = None
+    _rcm: ReactionCallbackManager = None
+
+    PREVIOUS_REACTION = '◀'
+    NEXT_REACTION = '▶'
+
+    def __init__(self, ctx: Context, channel: TextChannel, entries: Iterable[IndexEntry]):
+        """
+        :param ctx: The context of the command.
+        :param channel: The channel the entries are from.
+        :param entries: The entries in the order they should be listed in. Consumed as the pages are built.
+        """
+
+        self.ctx = ctx
+        self.channel = channel
+        self._entries = iter(entries)
+        self._next_entry = next(self._entries, None)
+        self._pages = []
+
+    @property
+    def complete(self) -> bool:
+        """ Whether all the pages have been built. """
+        return self._next_entry is None
+
+    def _build_page(self):
+        """ Take the entries of the next page. """
+        page, chars = [], 0
+
+        while self._next_entry is not None and len(page) < PAGE_FIELDS:
+            name, value = EmbedUtils.summary_field(self._next_entry)
+
+            # A page has at least one entry, a single field is always within the limits
+            if page and chars + len(name) + len(value) > PAGE_CHARS:
+                break
+
+            page.append(self._next_entry)
+            chars += len(name) + len(value)
+            self._next_entry = next(self._entries, None)
+
+        self._pages.append(page)
+
+    def _get_embed(self) -> Embed:
+        embed = EmbedUtils.index_summary(self.channel, self._pages[self._page])
+
+        # The number of the pages is not known until they are all built
+        if len(self._pages) > 1 or not self.complete:
+            embed.set_footer(text=f'Page {self._page + 1}/{len(self._pages) if self.complete else "?"}')
+
+        return embed
+
+    async def send(self):
+        """ Send the first page and add the reactions if there are more pages. """
+        self._build_page()
+
+        self._output = CommandOutput(self.ctx, **self._get_embed().to_dict())
+        await self._output.send()
+
+        if self.complete:
+            return
+
+        self._rcm = ReactionCallbackManager(self.ctx, self._output.msg, {
+            self.PREVIOUS_REACTION: self.previous,
+            self.NEXT_REACTION: self.next,
+        })
+        await self._rcm.asyncinit()
+
+        asyncio.ensure_future(self._expire())
+
+    async def _show(self, page: int):
+        self._page = page
+        if self._page == len(self._pages):
+            self._build_page()
+
+        self._output.embed = CommandOutput(self.ctx, **self._get_embed().to_dict()).embed
+        await self._output.msg.edit(embed=self._output.embed)
+
+    async def previous(self):
+        if self._page > 0:
+            await self._show(self._page - 1)
+
+    async def next(self):
+        if self._page + 1 < len(self._pages) or not self.complete:
+            await self._show(self._page + 1)
+
+    async def _expire(self):
+        await asyncio.sleep(PAGES_TIMEOUT)
+        await self._rcm.cleanup()
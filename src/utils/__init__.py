@@ -4,17 +4,21 @@ import asyncio
 import datetime
 import re
 import time
+from typing import Iterable, Tuple
 
 import PIL.Image
 import PIL.ImageOps
-import dateparser
 from discord import Color, Embed, Message, NotFound, Reaction, TextChannel, User
 from discord.ext.commands import Context
 
-import common
+from channel_index import ChannelIndex, IndexEntry
 from .list_to_image import FontMap, ListToImageBuilder
 from timeout_message import TimeoutMessage
 
+# The maximal lengths of the embed field names and values accepted by discord
+FIELD_NAME_LIMIT = 256
+FIELD_VALUE_LIMIT = 1024
+
 
 async def silent_delete(msg: Message) -> bool:
     """
@@ -163,18 +167,36 @@ class EmbedUtils:
         """
 
         # Get the embeds
-        _embeds = [msg.embeds[0] async for msg in channel.history() if msg.embeds]
+        _entries = ChannelIndex([IndexEntry.from_embed(msg.id, msg.embeds[0])
+                                 async for msg in channel.history() if msg.embeds])
+
+        return EmbedUtils.index_summary(channel, _entries, **kw)
+
+    @staticmethod
+    def summary_field(entry: IndexEntry) -> Tuple[str, str]:
+        """ Return the name and the value of the summary field of the entry, shortened to the limits of discord. """
+        name = f'**{entry.title}**, {entry.description}'
+        value = ', '.join(entry.field_names) or '...'
+
+        return name[:FIELD_NAME_LIMIT], value[:FIELD_VALUE_LIMIT]
+
+    @staticmethod
+    def index_summary(channel: TextChannel, entries: Iterable[IndexEntry], **kw) -> Embed:
+        """
+        Make a single embed with less information out of the indexed embeds of a channel.
 
-        # Sort by date
-        _embeds.sort(key=lambda x: (dateparser.parse(x.description or '') or common.MAX_DATETIME).date(),
-                     reverse=True)
+        :param channel: The channel the embeds are from.
+        :param entries: The entries in the order they should be listed in.
+        :param kw: The data the embed will be built from.
+            The title, description may and the color will be overridden.
+        :return: Embed summary of a channel.
+        """
 
         # Build the embed
         _embed = Embed.from_dict(kw)
-        for embed in _embeds:
-            _embed.add_field(name=f'**{embed.title}**, {embed.description}',
-                             value=', '.join(f.name for f in embed.fields) or '...',
-                             inline=False)
+        for entry in entries:
+            name, value = EmbedUtils.summary_field(entry)
+            _embed.add_field(name=name, value=value, inline=False)
         if _embed.fields:
             _embed.color = Color.red()
             _embed.description = _embed.description or ''
@@ -1,4 +1,5 @@
 import io
+from functools import lru_cache
 from typing import Generator, Union
 
 import discord
@@ -40,7 +41,9 @@ class FontMap:
         # TODO
 
 
+@lru_cache()
 def get_font(filename: str, size: int = 24) -> ImageFont.FreeTypeFont:
+    """ Load the font. Every font is loaded only once, on its first use. """
     return ImageFont.truetype(FONT_DIR + filename, size=size)
 
 
@@ -55,9 +58,9 @@ class ListToImageBuilder:
     background_color = (47, 49, 54, 255)
 
     # Font attrs
-    _fnt_header = get_font('uni-sans.heavy-caps.otf')
-    _fnt_body = get_font('Roboto-Medium.ttf')
-    _fnt_footer = get_font('Roboto-Italic.ttf')
+    _fnt_header: FreeTypeFont = None
+    _fnt_body: FreeTypeFont = None
+    _fnt_footer: FreeTypeFont = None
 
     # Other attrs
     _width = 0
@@ -87,9 +90,9 @@ class ListToImageBuilder:
         self.background_color = background_color or self.background_color
 
         # Fonts
-        self._fnt_header = font_header or self._fnt_header
-        self._fnt_body = font_body or self._fnt_body
-        self._fnt_footer = font_footer or self._fnt_footer
+        self._fnt_header = font_header or get_font('uni-sans.heavy-caps.otf')
+        self._fnt_body = font_body or get_font('Roboto-Medium.ttf')
+        self._fnt_footer = font_footer or get_font('Roboto-Italic.ttf')
 
         # Image, draw
         self._reset_image()